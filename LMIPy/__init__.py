@@ -6,6 +6,9 @@ from .dataset import Dataset
 from .geometry import Geometry
 from .collection import Collection
 from .table import Table
+from .asyncClient import AsyncClient
+from .searchIndex import SearchIndex
+from .catalog import Catalog
 from pkg_resources import get_distribution
 
 __version__ = get_distribution('LMIPy').version
\ No newline at end of file
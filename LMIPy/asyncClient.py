@@ -0,0 +1,68 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from .dataset import Dataset
+from .layer import Layer
+from .geometry import Geometry
+from .lmipy import Widget
+from .transport import get_transport
+
+
+class AsyncClient:
+    """
+    An asyncio interface returning the same Dataset, Layer, Widget and Geometry
+    objects as their constructors, so that many lookups can be awaited
+    concurrently, e.g. with asyncio.gather.
+
+    Each lookup runs on a bounded worker pool over the shared pooled transport,
+    so no more than `concurrency` requests are in flight at a time.
+
+    Parameters
+    ----------
+    server: str
+        Default server URL used when a lookup does not specify one.
+    concurrency: int
+        Maximum number of simultaneous lookups.
+    """
+    def __init__(self, server='https://api.resourcewatch.org', concurrency=16):
+        self.server = server
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        if get_transport().pool_size < concurrency:
+            get_transport().set_pool_size(concurrency)
+
+    def __repr__(self):
+        return f"AsyncClient {self.server} concurrency={self.concurrency}"
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Runs a blocking callable on the client's worker pool and awaits its result.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def dataset(self, id_hash, server=None, **kwargs):
+        """Returns a Dataset object."""
+        return await self.run(Dataset, id_hash=id_hash, server=server or self.server, **kwargs)
+
+    async def layer(self, id_hash, server=None, **kwargs):
+        """Returns a Layer object."""
+        return await self.run(Layer, id_hash=id_hash, server=server or self.server, **kwargs)
+
+    async def widget(self, id_hash, server=None, **kwargs):
+        """Returns a Widget object."""
+        return await self.run(Widget, id_hash=id_hash, server=server or self.server, **kwargs)
+
+    async def geometry(self, id_hash, server='https://production-api.globalforestwatch.org', **kwargs):
+        """Returns a Geometry object. Geostores default to the GFW production server."""
+        return await self.run(Geometry, id_hash=id_hash, server=server, **kwargs)
+
+    def close(self):
+        """Shuts down the worker pool."""
+        self.executor.shutdown(wait=False)
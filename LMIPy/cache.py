@@ -0,0 +1,426 @@
+import os
+import re
+import json
+import time
+import pickle
+import hashlib
+import sqlite3
+import weakref
+import threading
+from collections import OrderedDict
+from . import transport
+
+DEFAULT_TTL = {
+    'dataset': 3600,
+    'layer': 3600,
+    'widget': 3600,
+    'geometry': 7 * 24 * 3600,
+}
+
+class EntityCache:
+    """
+    A persistent SQLite store of raw API payloads for datasets, layers, widgets and geometries.
+
+    Payloads are keyed by (server, entity type, id, includes). Each entity type has
+    its own time-to-live, and the least recently used payloads are evicted once the
+    stored payloads exceed `max_bytes`.
+
+    Parameters
+    ----------
+    path: str
+        Path of the SQLite file holding the cache.
+    max_bytes: int
+        Size budget for the stored payloads.
+    ttl: dict
+        Seconds each entity type stays valid, e.g. {'dataset': 600}. Merged over DEFAULT_TTL.
+    """
+    def __init__(self, path='~/.lmipy/cache.sqlite', max_bytes=256 * 1024 * 1024, ttl=None):
+        self.path = os.path.expanduser(path)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.max_bytes = max_bytes
+        self.ttl = {**DEFAULT_TTL, **(ttl or {})}
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entities ("
+                          "server TEXT, entity_type TEXT, id TEXT, includes TEXT, payload TEXT, "
+                          "size INTEGER, stored_at REAL, accessed_at REAL, "
+                          "PRIMARY KEY (server, entity_type, id, includes))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entities_accessed ON entities (accessed_at)")
+        self.conn.commit()
+
+    def __repr__(self):
+        return f"EntityCache {self.path} {self.size()}/{self.max_bytes} bytes"
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM entities").fetchone()[0]
+
+    def size(self):
+        """Returns the number of bytes held by stored payloads."""
+        with self._lock:
+            return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entities").fetchone()[0]
+
+    def get(self, server, entity_type, id_hash, includes=''):
+        """
+        Returns a stored payload, or None if it is missing or older than the TTL of its type.
+        """
+        key = (server, entity_type, str(id_hash), includes or '')
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute("SELECT payload, stored_at FROM entities WHERE server=? AND entity_type=? "
+                                    "AND id=? AND includes=?", key).fetchone()
+            if not row:
+                return None
+            if now - row[1] > self.ttl.get(entity_type, 0):
+                self.conn.execute("DELETE FROM entities WHERE server=? AND entity_type=? AND id=? AND includes=?", key)
+                self.conn.commit()
+                return None
+            self.conn.execute("UPDATE entities SET accessed_at=? WHERE server=? AND entity_type=? AND id=? "
+                              "AND includes=?", (now, *key))
+            self.conn.commit()
+        return json.loads(row[0])
+
+    def set(self, server, entity_type, id_hash, includes, payload):
+        """
+        Stores a payload, evicting the least recently used payloads when over budget.
+        """
+        data = json.dumps(payload)
+        size = len(data.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                              (server, entity_type, str(id_hash), includes or '', data, size, now, now))
+            total = self.conn.execute("SELECT SUM(size) FROM entities").fetchone()[0]
+            if total > self.max_bytes:
+                rows = self.conn.execute("SELECT rowid, size FROM entities ORDER BY accessed_at").fetchall()
+                evict = []
+                for rowid, row_size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    evict.append((rowid,))
+                    total -= row_size
+                self.conn.executemany("DELETE FROM entities WHERE rowid=?", evict)
+            self.conn.commit()
+
+    def invalidate(self, server, entity_type, id_hash):
+        """Removes every stored payload of an entity, whatever its includes."""
+        with self._lock:
+            self.conn.execute("DELETE FROM entities WHERE server=? AND entity_type=? AND id=?",
+                              (server, entity_type, str(id_hash)))
+            self.conn.commit()
+
+    def clear(self):
+        """Removes all stored payloads."""
+        with self._lock:
+            self.conn.execute("DELETE FROM entities")
+            self.conn.commit()
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+class IdentityMap:
+    """
+    A process-wide registry of constructed entities keyed by (server, type, id).
+
+    Entities are held by weak reference, so an entry lives as long as something
+    else references it. The `maxsize` most recently used entities are also held
+    strongly, so that short-lived lookups (e.g. Layer.dataset()) are shared too.
+
+    Parameters
+    ----------
+    maxsize: int
+        Number of recently used entities kept alive by the map (0 keeps none).
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.refs = weakref.WeakValueDictionary()
+        self.recent = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return f"IdentityMap {len(self)} entities (maxsize={self.maxsize})"
+
+    def __len__(self):
+        return len(self.refs)
+
+    def _touch(self, key, obj):
+        if self.maxsize:
+            self.recent[key] = obj
+            self.recent.move_to_end(key)
+            while len(self.recent) > self.maxsize:
+                self.recent.popitem(last=False)
+
+    def get(self, server, entity_type, id_hash):
+        """Returns the registered entity, or None."""
+        if not id_hash:
+            return None
+        key = (server, entity_type, str(id_hash))
+        with self._lock:
+            obj = self.refs.get(key)
+            if obj is not None:
+                self._touch(key, obj)
+            return obj
+
+    def add(self, obj):
+        """
+        Registers an entity under its server, lower-cased class name and id,
+        unless another live instance is already registered for that key.
+        """
+        if not getattr(obj, 'id', None):
+            return
+        key = (obj.server, type(obj).__name__.lower(), str(obj.id))
+        with self._lock:
+            obj = self.refs.setdefault(key, obj)
+            self._touch(key, obj)
+        obj._identity = key
+
+    def discard(self, server, entity_type, id_hash):
+        """Forgets an entity so the next construction fetches it again."""
+        key = (server, entity_type, str(id_hash))
+        with self._lock:
+            self.refs.pop(key, None)
+            self.recent.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.refs.clear()
+            self.recent.clear()
+
+
+class QueryCache:
+    """
+    A two-tier (memory and SQLite) store of query results keyed by server, dataset id
+    and normalized SQL.
+
+    Each result is stored with the version (updatedAt and dataLastUpdated) of its
+    dataset, and is dropped when the dataset changes. The current version of a
+    dataset is checked against the server at most every `version_ttl` seconds.
+
+    Parameters
+    ----------
+    path: str
+        Path of the SQLite file holding the disk tier, or None to keep results in memory only.
+    max_entries: int
+        Number of results kept in memory, least recently used first out.
+    max_bytes: int
+        Size budget of the disk tier, least recently used first out.
+    version_ttl: int
+        Seconds a dataset version is trusted before it is checked again.
+    """
+    def __init__(self, path='~/.lmipy/queries.sqlite', max_entries=64, max_bytes=256 * 1024 * 1024, version_ttl=60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version_ttl = version_ttl
+        self.memory = OrderedDict()
+        self.versions = {}
+        self._lock = threading.Lock()
+        self.path = os.path.expanduser(path) if path else None
+        self.conn = None
+        if self.path:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, server TEXT, dataset TEXT, "
+                              "version TEXT, data BLOB, size INTEGER, accessed_at REAL)")
+            self.conn.commit()
+
+    def __repr__(self):
+        return f"QueryCache {len(self.memory)} results in memory, disk={self.path}"
+
+    @staticmethod
+    def normalize(sql):
+        """Collapses whitespace outside string literals and drops a trailing semicolon."""
+        parts = re.split(r"('(?:[^']|'')*')", sql.strip().rstrip(';').strip())
+        return ''.join(p if n % 2 else ' '.join(p.split()) for n, p in enumerate(parts))
+
+    def key(self, server, dataset_id, sql):
+        return hashlib.sha1(f'{server}|{dataset_id}|{self.normalize(sql)}'.encode('utf-8')).hexdigest()
+
+    def version(self, server, dataset_id, fetch):
+        """
+        Returns the current version of a dataset, calling fetch() if the known one is too old.
+        """
+        now = time.time()
+        known = self.versions.get((server, dataset_id))
+        if known and now - known[1] < self.version_ttl:
+            return known[0]
+        version = fetch()
+        self.versions[(server, dataset_id)] = (version, now)
+        return version
+
+    def get(self, server, dataset_id, sql, version):
+        """Returns a copy of a stored result of the given dataset version, or None."""
+        key = self.key(server, dataset_id, sql)
+        with self._lock:
+            entry = self.memory.get(key)
+            if entry is not None and entry[0] == version:
+                self.memory.move_to_end(key)
+                return entry[1].copy()
+            elif entry is not None:
+                del self.memory[key]
+            if self.conn is None:
+                return None
+            row = self.conn.execute("SELECT version, data FROM results WHERE key=?", (key,)).fetchone()
+            if not row:
+                return None
+            if row[0] != version:
+                self.conn.execute("DELETE FROM results WHERE key=?", (key,))
+                self.conn.commit()
+                return None
+            self.conn.execute("UPDATE results SET accessed_at=? WHERE key=?", (time.time(), key))
+            self.conn.commit()
+        result = pickle.loads(row[1])
+        self._remember(key, version, result)
+        return result.copy()
+
+    def set(self, server, dataset_id, sql, version, result):
+        """Stores a copy of a query result of the given dataset version."""
+        key = self.key(server, dataset_id, sql)
+        result = result.copy()
+        self._remember(key, version, result)
+        if self.conn is None:
+            return
+        data = pickle.dumps(result)
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (key, server, str(dataset_id), version, data, len(data), time.time()))
+            total = self.conn.execute("SELECT SUM(size) FROM results").fetchone()[0]
+            if total > self.max_bytes:
+                evict = []
+                for rowid, size in self.conn.execute("SELECT rowid, size FROM results ORDER BY accessed_at").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    evict.append((rowid,))
+                    total -= size
+                self.conn.executemany("DELETE FROM results WHERE rowid=?", evict)
+            self.conn.commit()
+
+    def _remember(self, key, version, result):
+        with self._lock:
+            self.memory[key] = (version, result)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def invalidate(self, server, dataset_id):
+        """Forgets the known version of a dataset, so stored results are checked again."""
+        self.versions.pop((server, str(dataset_id)), None)
+
+    def clear(self):
+        """Removes all stored results."""
+        with self._lock:
+            self.memory.clear()
+            self.versions.clear()
+            if self.conn is not None:
+                self.conn.execute("DELETE FROM results")
+                self.conn.commit()
+
+    def close(self):
+        with self._lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+identity_map = IdentityMap()
+_cache = None
+_query_cache = None
+
+def enable_cache(path='~/.lmipy/cache.sqlite', max_bytes=256 * 1024 * 1024, ttl=None):
+    """
+    Turns on the persistent entity cache used by get_dataset, get_layer, get_widget
+    and get_geometry, and returns it.
+    """
+    global _cache
+    disable_cache()
+    _cache = EntityCache(path=path, max_bytes=max_bytes, ttl=ttl)
+    return _cache
+
+def disable_cache():
+    """Turns off the persistent entity cache."""
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = None
+
+def get_cache():
+    """Returns the active EntityCache, or None if caching is disabled."""
+    return _cache
+
+def load_entity(server, entity_type, id_hash, includes=''):
+    if _cache is None:
+        return None
+    return _cache.get(server, entity_type, id_hash, includes)
+
+def store_entity(server, entity_type, id_hash, includes, payload):
+    if _cache is not None:
+        _cache.set(server, entity_type, id_hash, includes, payload)
+
+def enable_query_cache(path='~/.lmipy/queries.sqlite', max_entries=64, max_bytes=256 * 1024 * 1024, version_ttl=60):
+    """
+    Turns on the query result cache used by Dataset, Table and Layer queries, and returns it.
+    Set path=None to keep results in memory only.
+    """
+    global _query_cache
+    disable_query_cache()
+    _query_cache = QueryCache(path=path, max_entries=max_entries, max_bytes=max_bytes, version_ttl=version_ttl)
+    return _query_cache
+
+def disable_query_cache():
+    """Turns off the query result cache."""
+    global _query_cache
+    if _query_cache is not None:
+        _query_cache.close()
+    _query_cache = None
+
+def get_query_cache():
+    """Returns the active QueryCache, or None if query caching is disabled."""
+    return _query_cache
+
+def dataset_version(server, dataset_id):
+    """
+    Returns the version (updatedAt and dataLastUpdated) of a dataset on its server.
+    """
+    r = transport.get(f'{server}/v1/dataset/{dataset_id}')
+    if r.status_code != 200:
+        raise ValueError(f'Dataset with id={dataset_id} does not exist.')
+    attributes = r.json().get('data').get('attributes')
+    return f"{attributes.get('updatedAt')}|{attributes.get('dataLastUpdated')}"
+
+def cached_query(server, dataset_id, sql, run):
+    """
+    Returns the result of run() for a query on a dataset, served from the query cache
+    when it holds a result for the current version of the dataset.
+    """
+    if _query_cache is None or not dataset_id:
+        return run()
+    version = _query_cache.version(server, str(dataset_id), lambda: dataset_version(server, dataset_id))
+    result = _query_cache.get(server, dataset_id, sql, version)
+    if result is None:
+        result = run()
+        if result is not None:
+            _query_cache.set(server, dataset_id, sql, version, result)
+    return result
+
+def invalidate_entity(server, entity_type, id_hash):
+    """
+    Drops an entity from the identity map and the persistent cache after it changed.
+    """
+    if not id_hash:
+        return
+    identity_map.discard(server, entity_type, id_hash)
+    if entity_type == 'dataset':
+        identity_map.discard(server, 'table', id_hash)
+    if _cache is not None:
+        _cache.invalidate(server, entity_type, id_hash)
+    if _query_cache is not None and entity_type == 'dataset':
+        _query_cache.invalidate(server, id_hash)
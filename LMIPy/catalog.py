@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from .collection import Collection
+from .searchIndex import query_terms, searchable_fields
+
+DATASET_COLUMNS = ['provider', 'connectorType', 'status', 'published', 'protected', 'geoInfo', 'env',
+                   'createdAt', 'updatedAt']
+
+class Catalog:
+    """
+    A local SQLite mirror of the dataset catalogs of one or more servers, searched offline.
+
+    Catalog.sync() stores the same /v1/dataset payloads a Collection downloads, and
+    Catalog.collection() answers Collection searches, filters and orderings from the
+    file: a full-text (FTS5 trigram) index of names, descriptions, slugs and tags
+    narrows the datasets read, and the Collection applies its usual rules to them.
+
+    Parameters
+    ----------
+    path: str
+        Path of the SQLite file holding the catalog.
+    """
+    def __init__(self, path='~/.lmipy/catalog.sqlite'):
+        self.path = os.path.expanduser(path)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS syncs (server TEXT PRIMARY KEY, app TEXT, env TEXT, "
+                          "includes TEXT, synced_at REAL)")
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS datasets (server TEXT, id TEXT, "
+                          f"{', '.join(c + ' TEXT' for c in DATASET_COLUMNS)}, payload TEXT, PRIMARY KEY (server, id))")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entities (rowid INTEGER PRIMARY KEY, server TEXT, type TEXT, "
+                          "id TEXT, dataset TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entities_dataset ON entities (server, dataset)")
+        try:
+            self.conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS entities_fts USING fts5"
+                              "(name, description, slug, tags, tokenize='trigram')")
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False
+        self.conn.commit()
+
+    def __repr__(self):
+        return f"Catalog {self.path} {len(self)} datasets from {len(self.servers())} servers"
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM datasets").fetchone()[0]
+
+    def servers(self):
+        """Returns the servers synced into the catalog."""
+        with self._lock:
+            return [r[0] for r in self.conn.execute("SELECT server FROM syncs ORDER BY synced_at")]
+
+    def sync(self, server='https://api.resourcewatch.org', app=['gfw','rw'], env='production', includes=None,
+             page_size=1000, prefetch=4, fresh=False):
+        """
+        Downloads the catalog of a server and replaces its datasets in the mirror.
+        Returns the number of datasets stored.
+
+        Parameters
+        ----------
+        server: str
+            Server to mirror.
+        app: list
+            A list of string IDs of applications to mirror, e.g. ['gfw', 'rw']
+        includes: list
+            Relationships stored with each dataset (defaults to all the server supports).
+        """
+        col = Collection(server=server, app=app, env=env, includes=includes, pushdown=False,
+                         page_size=page_size, prefetch=prefetch, fresh=fresh)
+        datasets = list(col.datasets.values())
+        with self._lock:
+            try:
+                if self.fts:
+                    self.conn.execute("DELETE FROM entities_fts WHERE rowid IN (SELECT rowid FROM entities WHERE server=?)",
+                                      (server,))
+                self.conn.execute("DELETE FROM entities WHERE server=?", (server,))
+                self.conn.execute("DELETE FROM datasets WHERE server=?", (server,))
+                self.conn.executemany(f"INSERT INTO datasets VALUES ({', '.join('?' * (len(DATASET_COLUMNS) + 3))})",
+                                      [(server, d.get('id'), *[self.column_value(d['attributes'].get(c)) for c in DATASET_COLUMNS],
+                                        json.dumps(d)) for d in datasets])
+                for record in col.index.records:
+                    dataset = record['id'] if record['type'] in ['Dataset', 'Table'] else record['attributes'].get('dataset')
+                    rowid = self.conn.execute("INSERT INTO entities (server, type, id, dataset) VALUES (?, ?, ?, ?)",
+                                              (server, record['type'], record['id'], dataset)).lastrowid
+                    if self.fts:
+                        name, description, slug_tokens, tags = searchable_fields(record)
+                        self.conn.execute("INSERT INTO entities_fts (rowid, name, description, slug, tags) VALUES (?, ?, ?, ?, ?)",
+                                          (rowid, name, description, ' '.join(slug_tokens), ' '.join(tags)))
+                self.conn.execute("INSERT OR REPLACE INTO syncs VALUES (?, ?, ?, ?, ?)",
+                                  (server, ",".join(app), env, col.dataset_includes(), time.time()))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+        return len(datasets)
+
+    @staticmethod
+    def column_value(value):
+        if value is None:
+            return None
+        return str(value).lower()
+
+    def datasets(self, server, search='', filters=None):
+        """
+        Returns the dataset payloads of a server that may match a search and filters,
+        narrowed with the full-text index and the stored dataset columns.
+        """
+        sql = "SELECT payload FROM datasets WHERE server=?"
+        args = [server]
+        for k, v in (filters or {}).items():
+            if k not in DATASET_COLUMNS:
+                continue
+            if isinstance(v, (tuple, list)):
+                start, end = v
+                if start:
+                    sql += f" AND substr({k}, 1, {len(start)}) >= ?"
+                    args.append(start.lower())
+                if end:
+                    sql += f" AND substr({k}, 1, {len(end)}) <= ?"
+                    args.append(end.lower())
+            else:
+                sql += f" AND {k}=?"
+                args.append(self.column_value(v))
+        terms = set(query_terms(search))
+        if self.fts and all(len(t) >= 3 for t in terms):
+            match = ' OR '.join('"' + t.replace('"', '""') + '"' for t in terms)
+            sql += (" AND id IN (SELECT e.dataset FROM entities e JOIN entities_fts f ON f.rowid = e.rowid "
+                    "WHERE e.server=? AND entities_fts MATCH ?)")
+            args += [server, match]
+        with self._lock:
+            return [json.loads(r[0]) for r in self.conn.execute(sql, args)]
+
+    def collection(self, search='', server=None, object_type=['dataset', 'layer','table', 'widget'], filters=None,
+                   order='name', sort='desc', limit=1000, mapbox_token=None, lazy=False):
+        """
+        Returns a Collection searched, filtered and ordered from the catalog, without
+        any request to the server. Parameters are those of Collection.
+
+        Parameters
+        ----------
+        server: str
+            Synced server to search, defaults to the first one synced.
+        """
+        with self._lock:
+            syncs = self.conn.execute("SELECT server, includes FROM syncs ORDER BY synced_at").fetchall()
+        if not syncs:
+            raise ValueError('Catalog is empty, sync it with a server first')
+        server = server or syncs[0][0]
+        includes = dict(syncs).get(server)
+        if includes is None:
+            raise ValueError(f'Server {server} is not synced in the catalog')
+        return Collection(search=search, server=server, object_type=object_type, filters=filters, order=order,
+                          sort=sort, limit=limit, mapbox_token=mapbox_token, lazy=lazy, includes=includes,
+                          datasets=self.datasets(server, search=search, filters=filters))
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
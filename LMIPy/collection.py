@@ -1,13 +1,21 @@
-import requests
-import random
 import os
 import json
+import copy
+import heapq
+import time
 import datetime
+from collections import deque
+from functools import cmp_to_key
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pandas as pd
 from tqdm import tqdm
+from . import transport
 from .dataset import Dataset
 from .table import Table
 from .layer import Layer
-from .utils import create_class, show, flatten_list, parse_filters, server_uses_widgets
+from .searchIndex import SearchIndex, query_terms, matches
+from .utils import atomic_write, iter_prefetched, create_class, map_concurrently, show, flatten_list, split_filters, filter_matches, server_uses_widgets, parse_includes, server_supports_search
 
 class Collection:
     """
@@ -22,23 +30,62 @@ class Collection:
         A list of string IDs of applications to search, e.g. [‘gfw’, ‘rw’]
     limit: int
         Maximum number of items to return
-    order: str
-        Field to order items by, e.g. ’date’
+    order: str or list
+        Field(s) to order items by, e.g. ’date’ or ['provider', '-updatedAt'] (’-’ for descending)
     sort: str
         Rule to sort items by, either ascending (’asc’) or descending ('desc')
     search: str
-        String to search records by, e.g. ’Forest loss’
+        String to search records by, e.g. ’Forest loss’. When only datasets and tables are
+        searched, the search is sent to the server (see pushdown), so the collection and
+        its index, searched again with Collection.search(), hold only the matching datasets.
     object_type: list
         A list of strings of object types to search, e.g. [‘dataset’, ‘layer’]
     filters: dict
         A dictionary of filter key, value pairs e.g. {'provider', 'gee'}
         Possible search keys: 'connectorType', 'provider', 'status', 'published', 'protected', 'geoInfo'.
+        Filters the server can't evaluate are applied locally to each dataset, and a
+        tuple of ISO dates filters a date range, e.g. {'updatedAt': ('2019-01-01', None)}.
+    fresh: bool
+        If True, bypass the response cache and force a full download of the catalog.
+    lazy: bool
+        If True, objects returned by indexing or slicing the collection are only
+        fetched on first access to their attributes.
+    includes: list
+        Relationships to fetch with each dataset, e.g. [] for core attributes only.
+        Layers and widgets are always included when requested by object_type.
+    page_size: int
+        Number of datasets requested per page of the catalog.
+    prefetch: int
+        Number of following pages fetched concurrently while a page is processed.
+    pushdown: bool
+        If True, the search, filters and sort order are sent to servers able to evaluate
+        them, so only matching datasets are downloaded. Layers and widgets are searched
+        by their own name, description and slug, so the search is only sent when
+        object_type holds datasets and tables alone. Set to False to download the whole
+        catalog, e.g. to search it again locally with Collection.search().
+    workers: int
+        Number of objects created concurrently when slicing or materializing the collection.
+    datasets: list
+        Dataset payloads to build the collection from instead of fetching the catalog,
+        e.g. from a Catalog. Search, filters and order are then all applied locally.
+    servers: list
+        Servers to search concurrently instead of `server`, e.g. ['https://api.resourcewatch.org',
+        'https://production-api.globalforestwatch.org']. Items found on several servers are
+        kept once, from the first server listed.
+    stream: bool
+        If True, the catalog is not downloaded on construction and the collection holds
+        no items; iterate the matching items with Collection.iter_items(), which only
+        holds a few pages of the catalog in memory at a time.
     """
     def __init__(self, search='', app=['gfw','rw'], env='production', limit=1000, order='name', sort='desc',
                  object_type=['dataset', 'layer','table', 'widget'], server='https://api.resourcewatch.org',
-                 filters=None, mapbox_token=None):
-        self.search = [search.lower()] + search.lower().strip().split(' ')
-        self.server = server
+                 filters=None, mapbox_token=None, fresh=False, lazy=False, includes=None,
+                 page_size=1000, prefetch=4, pushdown=True, workers=8, datasets=None, servers=None, stream=False):
+        self.query = search
+        self.search_terms = query_terms(search)
+        self.server = servers[0] if servers else server
+        self.servers = servers
+        self.members = {}
         self.app = ",".join(app)
         self.env = env
         self.limit = limit
@@ -47,7 +94,26 @@ class Collection:
         self.filters = filters
         self.mapbox_token = mapbox_token
         self.object_type = object_type
-        self.collection = self.get_collection()
+        self.fresh = fresh
+        self.lazy = lazy
+        self.includes = includes
+        self.page_size = page_size
+        self.prefetch = prefetch
+        self.pushdown = pushdown
+        self.workers = workers
+        self.stream = stream
+        self.index = SearchIndex()
+        if stream and datasets is None:
+            self.datasets = {}
+            self.watermark = ''
+            self.collection = []
+        elif datasets is not None:
+            self.pushdown = False
+            self.datasets = {d.get('id'): d for d in datasets}
+            self.watermark = self.latest_update()
+            self.collection = self.index_datasets()
+        else:
+            self.collection = self.get_collection()
         self.iter_position = 0
 
     def _repr_html_(self):
@@ -81,29 +147,273 @@ class Collection:
     def __getitem__(self, key):
         items = self.collection[key]
         if type(items) == list:
-            return [create_class(item) for item in items]
+            return self.create_objects(items)
         else:
-            return create_class(items)
+            return self.create_object(items)
 
     def __len__(self):
         return len(self.collection)
 
+    def create_object(self, item):
+        """
+        Returns the object of a collection item, built from the attributes already
+        held by the collection unless it is lazy.
+        """
+        if self.lazy:
+            return create_class(item, lazy=True)
+        member = self.members.get(item.get('server'), self)
+        return create_class(item, hydrate=True, includes=member.dataset_includes())
+
+    def create_objects(self, items, workers=None):
+        """
+        Returns the objects of a list of collection items, created concurrently.
+        """
+        return map_concurrently(self.create_object, items, workers=workers or self.workers)
+
+    def materialize(self, workers=None):
+        """
+        Returns the Dataset, Table, Layer and Widget objects of every item in the collection.
+
+        Parameters
+        ----------
+        workers: int
+            Number of objects created concurrently (defaults to the collection's workers).
+        """
+        return self.create_objects(self.collection, workers=workers)
+
+    def to_dataframe(self, columns=None):
+        """
+        Returns the collection as a pandas DataFrame with one row per item, indexed by
+        its position in the collection. Repeated strings (type, provider, connectorType,
+        application, env, server) are categoricals and dates are UTC datetimes, so the
+        frame can be filtered and grouped without scanning the item dictionaries.
+
+        Parameters
+        ----------
+        columns: list
+            Extra attributes to add as columns, e.g. ['description', 'layerConfig'].
+        """
+        attribute_columns = ['name', 'slug', 'dataset', 'provider', 'connectorType', 'application', 'env',
+                             'published', 'protected', 'status', 'tableName', 'createdAt', 'updatedAt']
+        attribute_columns += [c for c in columns or [] if c not in attribute_columns]
+        data = {'type': [], 'id': [], 'server': [], **{c: [] for c in attribute_columns}}
+        for item in self.collection:
+            attributes = item.get('attributes') or {}
+            data['type'].append(item.get('type'))
+            data['id'].append(item.get('id'))
+            data['server'].append(item.get('server'))
+            for c in attribute_columns:
+                data[c].append(attributes.get(c))
+        data['application'] = [','.join(sorted(a)) if isinstance(a, list) else a for a in data['application']]
+        df = pd.DataFrame(data)
+        for c in ['type', 'server', 'provider', 'connectorType', 'application', 'env']:
+            df[c] = df[c].astype('category')
+        for c in ['createdAt', 'updatedAt']:
+            df[c] = pd.to_datetime(df[c], utc=True, errors='coerce')
+        return df
+
+    def iter_objects(self, prefetch=4, tile_urls=False):
+        """
+        Yields the object of each item in the collection, while a pool of workers
+        prepares the next `prefetch` objects in the background.
+
+        Parameters
+        ----------
+        prefetch: int
+            Number of objects prepared ahead of the one being used.
+        tile_urls: bool
+            If True, the map tile url of each Layer is also prepared and stored as
+            its `tile_url` attribute (None if it can't be created).
+        """
+        def prepare(item):
+            obj = self.create_object(item)
+            _ = obj.attributes
+            if tile_urls and isinstance(obj, Layer):
+                try:
+                    obj.tile_url = obj.parse_map_url()
+                except Exception:
+                    obj.tile_url = None
+            return obj
+        return iter_prefetched(prepare, list(self.collection), prefetch=prefetch)
+
     def get_collection(self):
         """
         Getter for the a collection object. In this case dataset and layers
         are the objects in the API. I.e. tables are a dataset type.
+        Every item is added to the search index so it can be searched again locally.
+        """
+        if self.servers:
+            members = map_concurrently(self.member, self.servers, workers=len(self.servers), return_exceptions=True)
+            self.members = {}
+            for server, member in zip(self.servers, members):
+                if isinstance(member, Exception):
+                    print(f'Unable to search {server}: {member}')
+                else:
+                    self.members[server] = member
+            if not self.members:
+                raise ValueError('No items found')
+            return self.merge_members()
+        self.datasets = {}
+        for datasets in self.iter_pages():
+            for d in datasets:
+                self.datasets[d.get('id')] = d
+        self.watermark = self.latest_update()
+        return self.index_datasets()
+
+    def member(self, server):
+        """
+        Returns the Collection of a single server of a federated collection.
         """
-        datasets = self.get_entities()
-        layers = []
-        # for d in datasets:
-        #     tmp_atts = d.get('attributes', None)
-        #     layers = tmp_atts.get('layer', None)
-        # layers = flatten_list(layers)
-        layers = flatten_list([d.get('attributes').get('layer') for d in datasets])
+        return Collection(search=self.query, app=self.app.split(','), env=self.env, limit=self.limit, order=self.order,
+                          sort=self.sort, object_type=self.object_type, server=server, filters=self.filters,
+                          mapbox_token=self.mapbox_token, fresh=self.fresh, lazy=self.lazy, includes=self.includes,
+                          page_size=self.page_size, prefetch=self.prefetch, pushdown=self.pushdown, workers=self.workers,
+                          stream=self.stream)
+
+    def merge_members(self):
+        """
+        Merges the items of the servers of a federated collection, keeping the first
+        item of each type and id, and returns the ordered search results.
+        """
+        self.index = SearchIndex()
+        self.datasets = {}
+        seen = set()
+        for server in self.servers:
+            member = self.members.get(server)
+            if member is None:
+                continue
+            for record in member.index.records:
+                if (record['type'], record['id']) not in seen:
+                    seen.add((record['type'], record['id']))
+                    self.index.add(record)
+            for id_hash, d in member.datasets.items():
+                self.datasets.setdefault(id_hash, d)
+        self.watermark = self.latest_update()
+        return self.order_results(self.index.search(self.query))
+
+    def latest_update(self):
+        """Returns the latest updatedAt of the datasets held by the collection."""
+        return max([d['attributes'].get('updatedAt') or '' for d in self.datasets.values()], default='')
+
+    def index_datasets(self):
+        """
+        Rebuilds the search index from the datasets held by the collection and returns
+        the ordered search results.
+        """
+        self.index = SearchIndex()
+        for record in self.to_records(self.expand_entities(list(self.datasets.values()))):
+            self.index.add(record)
+        return self.order_results(self.index.search(self.query))
+
+    def refresh(self):
+        """
+        Updates the collection with the datasets changed on the server since the last
+        sync, without downloading the whole catalog again.
+
+        Datasets are requested newest first and paging stops at the first dataset older
+        than the `watermark` (the latest updatedAt seen). Deleted datasets are found by
+        comparing the list of ids currently on the server with those held. Servers that
+        can't sort datasets are fetched again in full.
+
+        Returns a dictionary of the 'added', 'updated' and 'deleted' dataset ids.
+        """
+        if self.members:
+            changes = {'added': [], 'updated': [], 'deleted': []}
+            for member_changes in map_concurrently(lambda m: m.refresh(), list(self.members.values()),
+                                                   workers=len(self.members)):
+                for k in changes:
+                    changes[k] += member_changes[k]
+            self.collection = self.merge_members()
+            self.iter_position = 0
+            return changes
+        if not server_supports_search(self.server):
+            previous = dict(self.datasets)
+            self.collection = self.get_collection()
+            changed = [k for k, d in self.datasets.items() if k in previous and d != previous[k]]
+            return {'added': [k for k in self.datasets if k not in previous], 'updated': changed,
+                    'deleted': [k for k in previous if k not in self.datasets]}
+        url = self.entities_url(sort='-updatedAt')
+        changes = {'added': [], 'updated': [], 'deleted': []}
+        number = 1
+        while True:
+            datasets = self.get_page(url, number).get('data') or []
+            newer = [d for d in datasets if (d['attributes'].get('updatedAt') or '') >= self.watermark]
+            for d in newer:
+                if d.get('id') not in self.datasets:
+                    changes['added'].append(d.get('id'))
+                elif d != self.datasets[d.get('id')]:
+                    changes['updated'].append(d.get('id'))
+                self.datasets[d.get('id')] = d
+            if len(newer) < len(datasets) or len(datasets) < self.page_size:
+                break
+            number += 1
+        current = set()
+        for datasets in self.iter_pages(url=self.entities_url(includes=''), empty=True):
+            current.update(d.get('id') for d in datasets)
+        for id_hash in [k for k in self.datasets if k not in current]:
+            changes['deleted'].append(id_hash)
+            del self.datasets[id_hash]
+        self.watermark = self.latest_update()
+        self.collection = self.index_datasets()
+        self.iter_position = 0
+        return changes
+
+    def search(self, query):
+        """
+        Returns a new Collection of the items matching a query, searched in the
+        index of this collection without any request to the server. The index only
+        holds what the collection downloaded: if its own search was sent to the
+        server (see pushdown), only the datasets matching it are searched.
+
+        Parameters
+        ----------
+        query: str
+            String to search records by, e.g. 'Forest loss'
+        """
+        result = copy.copy(self)
+        result.datasets = dict(self.datasets)
+        result.query = query
+        result.search_terms = query_terms(query)
+        result.collection = result.order_results(self.index.search(query))
+        result.iter_position = 0
+        return result
+
+    def iter_items(self):
+        """
+        Yields the filtered collection items, unordered and without the limit applied.
+
+        A collection constructed with stream=True fetches them page by page as pages of
+        the catalog arrive, so only a few pages are held in memory at a time; otherwise
+        they are read from the catalog already downloaded.
+        """
+        if not self.stream:
+            for record in self.index.search(self.query):
+                yield record
+        elif self.servers:
+            seen = set()
+            for server in self.servers:
+                for item in self.member(server).iter_items():
+                    if (item['type'], item['id']) not in seen:
+                        seen.add((item['type'], item['id']))
+                        yield item
+        else:
+            for datasets in self.iter_pages():
+                for item in self.filter_results(self.expand_entities(datasets)):
+                    yield item
+
+    def expand_entities(self, datasets):
+        """
+        Returns the datasets, layers and widgets of a list of datasets that match the
+        object types of the collection and pass the filters the server did not apply.
+        """
+        _, local_filters = self.split_filters()
+        if local_filters:
+            datasets = [d for d in datasets if filter_matches(d.get('attributes') or {}, local_filters)]
+        layers = flatten_list([d.get('attributes').get('layer') or [] for d in datasets])
         if server_uses_widgets(server=self.server):
-            widgets = flatten_list([d.get('attributes').get('widget') for d in datasets])
+            widgets = flatten_list([d.get('attributes').get('widget') or [] for d in datasets])
         else:
-            widgets = None
+            widgets = []
         response_list = []
         if 'layer' in self.object_type:
             _ = [response_list.append(l) for l in layers]
@@ -111,92 +421,175 @@ class Collection:
             _ = [response_list.append(d) for d in datasets]
         if 'widget' in self.object_type:
             _ = [response_list.append(w) for w in widgets]
-        filtered_list = self.filter_results(response_list)
-        ordered_list = self.order_results(filtered_list)
-        return ordered_list
+        return response_list
 
     def get_entities(self):
-        hash = random.getrandbits(16)
-        filter_string = parse_filters(self.filters)
-        if server_uses_widgets(server=self.server):
-            url = (f'{self.server}/v1/dataset?app={self.app}&env={self.env}&{filter_string}'
-                   f'includes=layer,vocabulary,metadata,widget&page[size]=1000&hash={hash}')
-        else:
-            url = (f'{self.server}/v1/dataset?app={self.app}&env={self.env}&{filter_string}'
-                   f'includes=layer,metadata&page[size]=1000&hash={hash}')
-        r = requests.get(url)
-        response_list = r.json().get('data', None)
-        if not response_list:
+        """
+        Returns the datasets of every page of the catalog.
+        """
+        return flatten_list(list(self.iter_pages()))
+
+    def split_filters(self):
+        """
+        Returns the query parameters pushed down to the server and the filters left to apply locally.
+        """
+        if not self.pushdown:
+            return {}, dict(self.filters or {})
+        params, local_filters = split_filters(self.filters, self.server)
+        if server_supports_search(self.server):
+            if self.query.strip() and set(self.object_type) <= {'dataset', 'table'}:
+                params['search'] = self.query.strip()
+            sortable = ['name', 'slug', 'provider', 'connectorType', 'createdAt', 'updatedAt']
+            if all(key in sortable for key, _ in self.order_keys()):
+                params['sort'] = ','.join(f'-{key}' if descending else key for key, descending in self.order_keys())
+        return params, local_filters
+
+    def dataset_includes(self):
+        """
+        Returns the relationships fetched with each dataset of the catalog.
+        """
+        includes = [i for i in parse_includes(self.includes, self.server).split(',') if i]
+        if 'layer' in self.object_type and 'layer' not in includes:
+            includes.append('layer')
+        if 'widget' in self.object_type and 'widget' not in includes and server_uses_widgets(server=self.server):
+            includes.append('widget')
+        return ",".join(includes)
+
+    def entities_url(self, **kwargs):
+        """
+        Returns the catalog url, with any extra query parameters given as keywords.
+        """
+        params, _ = self.split_filters()
+        params = {'app': self.app, 'env': self.env, **params, 'includes': self.dataset_includes(), **kwargs}
+        return f'{self.server}/v1/dataset?{urlencode(params, safe=",")}'
+
+    def get_page(self, url, number):
+        """
+        Returns the response of a single page of the catalog.
+        """
+        params = {'page[number]': number, 'page[size]': self.page_size}
+        r = transport.get(url, params=params, fresh=self.fresh)
+        if r.status_code != 200:
+            raise ValueError(f'Bad response {r.status_code} from {r.url}')
+        return r.json()
+
+    def iter_pages(self, url=None, empty=False):
+        """
+        Yields the datasets of each page of the catalog in order, fetching up to
+        `prefetch` following pages concurrently. Unless empty is True, a catalog
+        without datasets raises a ValueError.
+        """
+        url = url or self.entities_url()
+        first = self.get_page(url, 1)
+        datasets = first.get('data', None)
+        if not datasets:
+            if empty:
+                return
             raise ValueError('No items found')
-        return response_list
+        yield datasets
+        total_pages = (first.get('meta') or {}).get('total-pages')
+        if not total_pages:
+            number = 1
+            while len(datasets) >= self.page_size:
+                number += 1
+                datasets = self.get_page(url, number).get('data') or []
+                if datasets:
+                    yield datasets
+            return
+        pending = deque()
+        next_page = 2
+        executor = ThreadPoolExecutor(max_workers=max(1, self.prefetch))
+        try:
+            while next_page <= total_pages or pending:
+                while next_page <= total_pages and len(pending) < max(1, self.prefetch):
+                    pending.append(executor.submit(self.get_page, url, next_page))
+                    next_page += 1
+                yield pending.popleft().result().get('data') or []
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
 
     def filter_results(self, response_list):
         """Search by a list of strings to return a filtered list of Dataset or Layer objects"""
-        filtered_response = []
+        return [record for record in self.to_records(response_list) if matches(record, self.search_terms)]
+
+    def to_records(self, response_list):
+        """Returns the collection records of the items matching the object types of the collection."""
+        return_layers = 'layer' in self.object_type
+        return_datasets = 'dataset' in self.object_type
+        return_tables = 'dataset' in self.object_type
+        return_widgets = 'widget' in self.object_type
         collection = []
         for item in response_list:
-            return_layers = 'layer' in self.object_type
-            return_datasets = 'dataset' in self.object_type
-            return_tables = 'dataset' in self.object_type
-            return_widgets = 'widget' in self.object_type
-            #print(f"Filter: {type(item)}, {item}")
-            if type(item) == dict:
-                tmp_atts = item.get('attributes')
-                name = tmp_atts.get('name', None)
-                description = tmp_atts.get('description', None)
-                slug = tmp_atts.get('slug', None)
-            else:
-                name = None
-                description = None
-                slug = None
-            found = []
-            if description:
-                description = description.lower()
-                found.append(any([s in description for s in self.search]))
-            if name:
-                name = name.lower()
-                found.append(any([s in name for s in self.search]))
-            if slug:
-                slug = slug.lower().split('_')
-                found.append(any([s in slug for s in self.search]))
-            if any(found):
-                if len(filtered_response) < self.limit:
-                    filtered_response.append(item)
-                if item.get('type') == 'dataset' and item.get('attributes').get('provider') in ['csv', 'json'] and return_tables:
-                    collection.append({'type': 'Table','id': item.get('id'), 'attributes': item.get('attributes'), 'server': self.server})
-                elif item.get('type') == 'dataset' and item.get('attributes').get('provider') != ['csv','json'] and return_datasets:
-                    collection.append({'type': 'Dataset','id': item.get('id'), 'attributes': item.get('attributes'), 'server': self.server})
-                if item.get('type') == 'layer' and return_layers:
-                    collection.append({'type': 'Layer', 'id': item.get('id'), 'attributes': item.get('attributes'), 'server': self.server, 'mapbox_token':self.mapbox_token})
-                if item.get('type') == 'widget' and return_widgets:
-                    collection.append({'type': 'Widget', 'id': item.get('id'), 'attributes': item.get('attributes'), 'server': self.server})
+            if item.get('type') == 'dataset' and item.get('attributes').get('provider') in ['csv', 'json'] and return_tables:
+                collection.append({'type': 'Table','id': item.get('id'), 'attributes': item.get('attributes'), 'server': self.server})
+            elif item.get('type') == 'dataset' and item.get('attributes').get('provider') != ['csv','json'] and return_datasets:
+                collection.append({'type': 'Dataset','id': item.get('id'), 'attributes': item.get('attributes'), 'server': self.server})
+            if item.get('type') == 'layer' and return_layers:
+                collection.append({'type': 'Layer', 'id': item.get('id'), 'attributes': item.get('attributes'), 'server': self.server, 'mapbox_token':self.mapbox_token})
+            if item.get('type') == 'widget' and return_widgets:
+                collection.append({'type': 'Widget', 'id': item.get('id'), 'attributes': item.get('attributes'), 'server': self.server})
         return collection
 
+    def order_keys(self):
+        """
+        Returns the (attribute, descending) pairs the collection is ordered by. Keys
+        prefixed with '-' are descending; a single unprefixed key follows the sort rule.
+        """
+        if isinstance(self.order, str):
+            if self.order.startswith('-'):
+                return [(self.order[1:], True)]
+            return [(self.order, self.sort.lower() == 'asc')]
+        return [(k[1:], True) if k.startswith('-') else (k, False) for k in self.order]
+
     def order_results(self, collection_list):
-        """Operate on a list of objects given the order key, limit, and rule a user has passed"""
-        tmp_sorted = []
+        """
+        Operate on a list of objects given the order key(s), limit, and rule a user has passed.
+
+        Items are stable-sorted by each key in turn, with items missing a key last. When
+        the limit is much smaller than the list only the top `limit` items are kept
+        while sorting, in O(n log limit).
+        """
+        keys = self.order_keys()
+        def value(item, key):
+            attributes = item['attributes']
+            return attributes.get(key, attributes.get(key.lower()))
+        if collection_list and not all(any(value(c, k) is not None for c in collection_list) for k, _ in keys):
+            raise ValueError(f'[Order-error] Param does not exist in collection: {self.order}, rule: {self.sort}')
+        def compare(a, b):
+            for key, descending in keys:
+                x, y = value(a, key), value(b, key)
+                if x == y:
+                    continue
+                if x is None or y is None:
+                    return 1 if x is None else -1
+                result = (x > y) - (x < y)
+                return -result if descending else result
+            return 0
         try:
-            d = {}
-            duplicate = {}
-            for n, z in enumerate([c['attributes'].get(self.order.lower()) for c in collection_list]):
-                if duplicate.get(z, None):
-                    d[f'{z} {duplicate[z]}'] = collection_list[n]
-                    duplicate[z] += 1
-                else:
-                    d[z] = collection_list[n]
-                    duplicate[z] = 1
-            keys = sorted(d, reverse=self.sort.lower() == 'asc')
-            for key in keys:
-                tmp_sorted.append(d[key])
-        except:
+            if self.limit * 4 < len(collection_list):
+                return heapq.nsmallest(self.limit, collection_list, key=cmp_to_key(compare))
+            return sorted(collection_list, key=cmp_to_key(compare))[0:self.limit]
+        except TypeError:
             raise ValueError(f'[Order-error] Param does not exist in collection: {self.order}, rule: {self.sort}')
-        if self.limit < len(tmp_sorted):
-            tmp_sorted = tmp_sorted[0:self.limit]
-        return tmp_sorted
 
-    def save(self, path=None):
+    def save(self, path=None, workers=None, resume=True):
         """
         Save all entities in the collection to a local path.
+
+        Each parent dataset is downloaded once, by a pool of workers, and written
+        atomically as {id}.json. Saved ids are checkpointed in a manifest file, so
+        saving again to the same path resumes an interrupted backup.
+
+        Parameters
+        ----------
+        path: str
+            Folder to save to. Defaults to a date-referenced folder in ./LMI-BACKUP
+        workers: int
+            Number of datasets downloaded concurrently (defaults to the collection's workers).
+        resume: bool
+            If True, datasets recorded in the manifest of the folder are not saved again.
         """
         if not path:
             path = './LMI-BACKUP'
@@ -210,35 +603,71 @@ class Collection:
            if not os.path.isdir(path):
                 os.mkdir(path)
         print(f'Saving to path: {path}')
+        manifest_path = f'{path}/.lmipy-manifest.json'
         saved = []
+        if resume and os.path.isfile(manifest_path):
+            with open(manifest_path) as fp:
+                saved = [ds_id for ds_id in json.load(fp).get('saved', []) if os.path.isfile(f'{path}/{ds_id}.json')]
+        items_by_dataset = {}
+        for item in self.collection:
+            if item.get('type') in ['Dataset', 'Table']:
+                ds_id = item['id']
+            else:
+                ds_id = item['attributes']['dataset']
+            items_by_dataset.setdefault(ds_id, []).append(item)
+        pending = [ds_id for ds_id in items_by_dataset if ds_id not in saved]
+        if len(pending) < len(items_by_dataset):
+            print(f'Resuming: {len(items_by_dataset) - len(pending)} datasets already saved.')
+
+        def save_dataset(ds_id):
+            server = items_by_dataset[ds_id][0].get('server') or self.server
+            if server_uses_widgets(server):
+                url_args = "vocabulary,metadata,layer,widget"
+            else:
+                url_args = "metadata,layer"
+            url = f'{server}/v1/dataset/{ds_id}?includes={url_args}'
+            r = transport.get(url)
+            if r.status_code != 200:
+                raise ValueError(f'Bad response {r.status_code} from {r.url}')
+            save_json = {
+                "id": ds_id,
+                "type": "dataset",
+                "server": server,
+                "attributes": r.json()['data']['attributes']
+            }
+            data = json.dumps(save_json)
+            atomic_write(f"{path}/{ds_id}.json", data)
+            return len(data)
+
+        def checkpoint():
+            atomic_write(manifest_path, json.dumps({'server': self.server, 'saved': saved}))
+
         failed = []
-        if server_uses_widgets(self.server):
-            url_args = "vocabulary,metadata,layer,widget"
-        else:
-            url_args = "metadata,layer"
-        for item in tqdm(self):
-            if item['id'] not in saved:
-                entity_type = item.get('type')
-                if entity_type in ['Dataset', 'Table']:
-                    ds_id = item['id']
-                else:
-                    ds_id = item['attributes']['dataset']
+        failed_ids = []
+        written = 0
+        start = time.time()
+        executor = ThreadPoolExecutor(max_workers=max(1, workers or self.workers))
+        futures = {}
+        try:
+            futures = {executor.submit(save_dataset, ds_id): ds_id for ds_id in pending}
+            for n, future in enumerate(tqdm(as_completed(futures), total=len(futures))):
+                ds_id = futures[future]
                 try:
-                    url = f'{self.server}/v1/dataset/{ds_id}?includes={url_args}'
-                    r = requests.get(url)
-                    dataset_config = r.json()['data']
-                except:
-                    failed.append(item)
-
-                save_json = {
-                    "id": ds_id,
-                    "type": "dataset",
-                    "server": self.server,
-                    "attributes": dataset_config['attributes']
-                }
-                with open(f"{path}/{ds_id}.json", 'w') as fp:
-                    json.dump(save_json, fp)
-
+                    written += future.result()
+                    saved.append(ds_id)
+                except Exception:
+                    failed_ids.append(ds_id)
+                    failed += items_by_dataset[ds_id]
+                if n % 50 == 0:
+                    checkpoint()
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+            checkpoint()
+        elapsed = max(time.time() - start, 1e-9)
+        done = len(pending) - len(failed_ids)
+        print(f'Saved {done} datasets in {elapsed:.1f}s ({done / elapsed:.1f} datasets/s, {written / elapsed / 1e6:.2f} MB/s)')
         if len(failed) > 0:
             print(f'Some entities failed to save: {failed}')
             return failed
@@ -1,13 +1,15 @@
-import requests
 import json
-import random
+import functools
+import pandas as pd
 import geopandas as gpd
 import os
 import datetime
 #from shapely.geometry import shape
 from pprint import pprint
+from . import transport
+from .cache import load_entity, store_entity, invalidate_entity, identity_map, cached_query
 from .layer import Layer
-from .utils import html_box, nested_set, server_uses_widgets
+from .utils import html_box, nested_set, server_uses_widgets, parse_includes, covers_includes, is_payload, fetch_many, iter_prefetched, decode_geometries, write_parquet, carto_dtypes
 from .lmipy import Vocabulary, Metadata, Widget
 
 
@@ -20,43 +22,107 @@ class Dataset:
     id_hash: int
         An ID hash of the dataset in the API.
     attributes: dic
-        A dictionary holding the attributes of a dataset.
+        A dictionary holding the attributes of a dataset. If it is a full dataset
+        payload ({'id', 'type', 'attributes'}) it is used without another request.
     sever: str
         A URL string of the vizzuality server.
+    lazy: bool
+        If True, only the id and server are recorded on construction, and the dataset
+        is fetched on first access to attributes, layers, metadata, vocabulary or widget.
+    includes: list
+        Relationships to fetch with the dataset, e.g. ['layer'] or [] for core attributes
+        only. Defaults to all of layer, widget, vocabulary and metadata the server supports.
+
+    Layers and widgets embedded in the dataset response are built directly from
+    that response, so constructing a Dataset costs a single request.
+
+    Constructing a Dataset by id returns the already loaded instance when the
+    same id on the same server was constructed before in this process. Constructing
+    it from a payload updates that instance with the payload.
     """
-    def __init__(self, id_hash=None, attributes=None, server='https://api.resourcewatch.org', token=None):
+    def __new__(cls, id_hash=None, attributes=None, server='https://api.resourcewatch.org', *args, **kwargs):
+        if id_hash and (not attributes or is_payload(attributes, 'dataset')):
+            existing = identity_map.get(server, cls.__name__.lower(), id_hash)
+            if existing is not None and covers_includes(existing.includes, parse_includes(kwargs.get('includes'), server)):
+                return existing
+            elif existing is not None:
+                identity_map.discard(server, cls.__name__.lower(), id_hash)
+        return super().__new__(cls)
+
+    def __init__(self, id_hash=None, attributes=None, server='https://api.resourcewatch.org', token=None, lazy=False,
+                 includes=None):
+        if '_identity' in self.__dict__:
+            if is_payload(attributes, 'dataset'):
+                current = '' if self.__dict__.get('_lazy') else self.includes
+                self.hydrate(dict(attributes.get('attributes')), keep=True)
+                self.includes = ','.join(i for i in dict.fromkeys(current.split(',') + parse_includes(includes, server).split(',')) if i)
+            return
         self.id = id_hash
-        self.layers = []
         self.server = server
-        if not attributes:
-            self.attributes = self.get_dataset()
+        self.includes = parse_includes(includes, server)
+        if not attributes and lazy:
+            self._lazy = True
+        elif not attributes:
+            self.hydrate(self.get_dataset())
         elif attributes and token:
             created_dataset = self.new_dataset(token=token, attributes=attributes, server=server)
-            self.attributes = created_dataset.attributes
+            self.hydrate(created_dataset.attributes)
             self.id = created_dataset.id
+        elif is_payload(attributes, 'dataset'):
+            self.id = attributes.get('id')
+            self.hydrate(dict(attributes.get('attributes')))
         elif attributes:
             self.id = attributes.get('id')
-            self.attributes = self.get_dataset()
-
-        if len(self.attributes.get('layer', [])) > 0:
-            self.layers = [Layer(id_hash=l.get('id', None), attributes=l, server=self.server) for l in self.attributes.get('layer')]
-            _ = self.attributes.pop('layer')
-        if len(self.attributes.get('metadata', [])) > 0:
-            self.metadata = [Metadata(attributes=m, server=self.server) for m in self.attributes.get('metadata')]
-            _ = self.attributes.pop('metadata')
-        else:
-            self.metadata = []
-        if len(self.attributes.get('vocabulary', [])) > 0:
-            self.vocabulary =[Vocabulary(attributes=v, server=self.server) for v in self.attributes.get('vocabulary')]
-            _ = self.attributes.pop('vocabulary')
-        else:
-            self.vocabulary = []
-        if len(self.attributes.get('widget', [])) > 0:
-            self.widget =[Widget(w.get('id'), attributes=1, server=self.server) for w in self.attributes.get('widget')]
-            _ = self.attributes.pop('widget')
-        else:
-            self.widget = []
-        self.url = f"{self.server}/v1/dataset/{id_hash}?hash={random.getrandbits(16)}"
+            self.hydrate(self.get_dataset())
+        self.url = f"{self.server}/v1/dataset/{self.id}"
+        identity_map.add(self)
+
+    def __getattr__(self, name):
+        if name in ['attributes', 'layers', 'metadata', 'vocabulary', 'widget'] and self.__dict__.get('_lazy'):
+            self.hydrate(self.get_dataset())
+            return getattr(self, name)
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def hydrate(self, attributes, keep=False):
+        """
+        Sets the dataset attributes, building the child Layers, Metadata, Vocabularies and
+        Widgets embedded in them. If keep, relationships the attributes don't include keep
+        their current children.
+        """
+        def replaced(key, name):
+            return not keep or key in attributes or name not in self.__dict__
+        if replaced('layer', 'layers'):
+            self.layers = [Layer(id_hash=l.get('id', None), attributes=l, server=self.server) for l in attributes.pop('layer', None) or []]
+        if replaced('metadata', 'metadata'):
+            self.metadata = [Metadata(attributes=m, server=self.server) for m in attributes.pop('metadata', None) or []]
+        if replaced('vocabulary', 'vocabulary'):
+            self.vocabulary = [Vocabulary(attributes=v, server=self.server) for v in attributes.pop('vocabulary', None) or []]
+        if replaced('widget', 'widget'):
+            self.widget = [Widget(w.get('id'), attributes=w, server=self.server) for w in attributes.pop('widget', None) or []]
+        self.attributes = attributes
+        self._lazy = False
+        return self
+
+    @classmethod
+    def get_many(cls, ids, server='https://api.resourcewatch.org', workers=8, includes=None):
+        """
+        Fetch many datasets by id.
+
+        Returns a tuple of (datasets, errors): the datasets in the order of `ids`, with None
+        where a lookup failed, and a dictionary of the errors keyed by id.
+
+        Parameters
+        ----------
+        ids: list
+            A list of dataset ids.
+        workers: int
+            Maximum number of concurrent requests when a bulk lookup is unavailable.
+        includes: list
+            Relationships to fetch with each dataset.
+        """
+        includes = parse_includes(includes, server)
+        params = {'includes': includes} if includes else None
+        return fetch_many(cls, ids, server, 'dataset', workers=workers, params=params, includes=includes)
 
     def __repr__(self):
         return self.__str__()
@@ -67,43 +133,199 @@ class Dataset:
     def _repr_html_(self):
         return html_box(item=self)
 
-    def get_dataset(self):
+    def get_dataset(self, fresh=False):
         """
         Retrieve a dataset from a server by ID.
-        """
+
+        Parameters
+        ----------
+        fresh: bool
+            If True, bypass the response and entity caches and force a full download.
+        """
+        includes = self.includes
+        if not fresh:
+            cached = load_entity(self.server, 'dataset', self.id, includes)
+            if cached is not None:
+                return cached
         try:
-            hash = random.getrandbits(16)
-            if server_uses_widgets(self.server):
-                url = f'{self.server}/v1/dataset/{self.id}?includes=layer,widget,vocabulary,metadata&hash={hash}'
-            else:
-                url = f'{self.server}/v1/dataset/{self.id}?includes=layer,metadata&hash={hash}'
-            r = requests.get(url)
+            url = f'{self.server}/v1/dataset/{self.id}'
+            if includes:
+                url += f'?includes={includes}'
+            r = transport.get(url, fresh=fresh)
         except:
             raise ValueError(f'Unable to get Dataset {self.id} from {r.url}')
         if r.status_code == 200:
-            return r.json().get('data').get('attributes')
+            attributes = r.json().get('data').get('attributes')
+            store_entity(self.server, 'dataset', self.id, includes, attributes)
+            return attributes
         else:
             raise ValueError(f'Dataset with id={self.id} does not exist.')
 
-    def carto_query(self, sql):
+    def carto_query(self, sql, format='json'):
         """
         Returns a GeoPandas GeoDataFrame for CARTO datasets. The sql query should
         always use dataset as the source (i.e. 'from dataset') as this will be
         replaced with the tableName from dataset.attributes.
+
+        Parameters
+        ----------
+        sql: str
+            Valid SQL string.
+        format: str
+            Format the rows are transferred in: 'json', or 'csv' which is smaller and
+            parsed in chunks straight into typed columns.
         """
         sql = sql.lower().replace('from data',f"FROM {self.attributes.get('tableName')}")
+        return cached_query(self.server, self.id, f'{format}: {sql}', lambda: self.carto_frame(sql, format=format))
+
+    def carto_url(self):
+        """
+        Returns the SQL API url of the CARTO account of the dataset.
+        """
         if not self.attributes.get('connectorUrl'):
             raise ValueError("ConnectorUrl attribute missing.")
         account = self.attributes.get('connectorUrl').split('/')[2].split('.')[0]
-        urlCarto = f"https://{account}.carto.com/api/v2/sql"
+        return f"https://{account}.carto.com/api/v2/sql"
+
+    def carto_rows(self, sql):
+        """
+        Returns the rows of a SQL statement run on the CARTO account of the dataset.
+        """
         params = {"q": sql}
-        r = requests.get(urlCarto, params=params)
+        r = transport.get(self.carto_url(), params=params)
+        if r.status_code == 200:
+            return r.json().get('rows') or []
+        else:
+            raise ValueError(f"Bad response from Carto {r.status_code}: {r.json()}")
+
+    def carto_fields(self, sql):
+        """
+        Returns the fields ({name: {'type', 'pgtype'}}) of the result of a SQL statement
+        run on the CARTO account of the dataset, without fetching any rows.
+        """
+        params = {"q": f"SELECT * FROM ({sql}) AS q LIMIT 0"}
+        r = transport.get(self.carto_url(), params=params)
         if r.status_code == 200:
-            return gpd.GeoDataFrame(r.json().get('rows'))
+            return r.json().get('fields') or {}
         else:
             raise ValueError(f"Bad response from Carto {r.status_code}: {r.json()}")
 
-    def query(self, sql="SELECT * FROM data LIMIT 5"):
+    def carto_csv(self, sql, chunksize=100000):
+        """
+        Yields the result of a SQL statement run on the CARTO account of the dataset
+        as DataFrames of at most `chunksize` rows, parsed from a streamed CSV response.
+        Columns are typed from the fields of the result, so that every chunk has the
+        same dtypes.
+        """
+        dtypes, dates = carto_dtypes(self.carto_fields(sql))
+        params = {"q": sql, "format": "csv"}
+        r = transport.get(self.carto_url(), params=params, stream=True)
+        if r.status_code != 200:
+            raise ValueError(f"Bad response from Carto {r.status_code}: {r.text}")
+        r.raw.decode_content = True
+        try:
+            for chunk in pd.read_csv(r.raw, chunksize=chunksize, dtype=dtypes, parse_dates=dates,
+                                     true_values=['true', 't'], false_values=['false', 'f']):
+                yield chunk
+        except pd.errors.EmptyDataError:
+            return
+        finally:
+            r.close()
+
+    def carto_frame(self, sql, format='json'):
+        """
+        Returns the result of a SQL statement run on the CARTO account of the dataset as a
+        GeoDataFrame, with the_geom decoded into its geometry column (EPSG:4326).
+        """
+        if format == 'json':
+            return decode_geometries(self.carto_rows(sql))
+        elif format == 'csv':
+            chunks = list(self.carto_csv(sql))
+            return decode_geometries(pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame())
+        raise ValueError(f"Unknown CARTO format {format}. Must be 'json' or 'csv'.")
+
+    def iter_query(self, sql="SELECT * FROM data", chunksize=10000, prefetch=2, format='json'):
+        """
+        Yields the result of a query on a CARTO dataset as GeoPandas GeoDataFrames of at
+        most `chunksize` rows, paging the query on the server so that the full result
+        is never held in memory.
+
+        Results whose cartodb_id is set and unique on every row are paged by cartodb_id
+        (ranges of ids when they are dense, keyset pagination otherwise), and the next
+        `prefetch` pages are fetched concurrently while a page is used. Other results
+        have no key to page them by consistently, so they are run as a single query whose response is
+        streamed as CSV and split into pages as it arrives, whatever the format.
+
+        Parameters
+        ----------
+        sql: str
+            Valid SQL string, using 'from data' as the source.
+        chunksize: int
+            Maximum number of rows per GeoDataFrame.
+        prefetch: int
+            Number of pages fetched ahead of the one being used.
+        format: str
+            Format the pages are transferred in, 'json' or 'csv'.
+        """
+        sql = sql.lower().replace('from data',f"FROM {self.attributes.get('tableName')}").strip().rstrip(';')
+        fetch = functools.partial(self.carto_frame, format=format)
+        try:
+            bounds = self.carto_rows(f'SELECT min(cartodb_id) AS lo, max(cartodb_id) AS hi, count(*) AS n, '
+                                     f'count(cartodb_id) AS ids, count(DISTINCT cartodb_id) AS distinct_ids '
+                                     f'FROM ({sql}) AS q')[0]
+        except ValueError:
+            bounds = None
+        if bounds and bounds.get('n') == 0:
+            return
+        if bounds and not bounds.get('n') == bounds.get('ids') == bounds.get('distinct_ids'):
+            bounds = None
+        if bounds and bounds['hi'] - bounds['lo'] < 2 * bounds['n']:
+            pages = (f'SELECT * FROM ({sql}) AS q WHERE cartodb_id >= {lo} AND cartodb_id < {lo + chunksize} '
+                     f'ORDER BY cartodb_id' for lo in range(bounds['lo'], bounds['hi'] + 1, chunksize))
+            for frame in iter_prefetched(fetch, pages, prefetch=prefetch):
+                if len(frame):
+                    yield frame
+        elif bounds:
+            last = bounds['lo'] - 1
+            while True:
+                frame = fetch(f'SELECT * FROM ({sql}) AS q WHERE cartodb_id > {last} '
+                              f'ORDER BY cartodb_id LIMIT {chunksize}')
+                if len(frame):
+                    last = int(frame['cartodb_id'].iloc[-1])
+                    yield frame
+                if len(frame) < chunksize:
+                    return
+        else:
+            for chunk in self.carto_csv(sql, chunksize=chunksize):
+                if len(chunk):
+                    yield decode_geometries(chunk)
+
+    def query_to_parquet(self, sql="SELECT * FROM data", path=None, chunksize=10000, prefetch=2, **kwargs):
+        """
+        Writes the result of a query to a Parquet file (GeoParquet if it has geometries),
+        page by page as they arrive from iter_query, so the full result is never held in
+        memory. The file is only replaced once completely written. Returns the number of
+        rows written; read the file back with LMIPy.utils.read_parquet.
+
+        Requires pyarrow (pip install LMIPy[parquet]).
+
+        Parameters
+        ----------
+        sql: str
+            Valid SQL string, using 'from data' as the source.
+        path: str
+            Path of the Parquet file, defaults to '<dataset id>.parquet'.
+        chunksize: int
+            Maximum number of rows per page.
+        prefetch: int
+            Number of pages fetched ahead of the one being written.
+
+        Other keywords are passed to iter_query, e.g. order_by for a Table.
+        """
+        path = path or f'{self.id}.parquet'
+        return write_parquet(self.iter_query(sql, chunksize=chunksize, prefetch=prefetch, **kwargs), path)
+
+    def query(self, sql="SELECT * FROM data LIMIT 5", format='json'):
         """
         Query a Dataset object
 
@@ -114,10 +336,12 @@ class Dataset:
         ----------
         sql: str
             Valid SQL string.
+        format: str
+            Format the rows are transferred in, 'json' or 'csv' (see carto_query).
         """
         provider = self.attributes.get('provider', None)
         if provider == 'cartodb':
-            return self.carto_query(sql=sql)
+            return self.carto_query(sql=sql, format=format)
         else:
             raise ValueError(f'Unable to perform query on datasets with provider {provider}. Must be `cartodb`.')
 
@@ -171,7 +395,7 @@ class Dataset:
         try:
             url = f"{self.server}/dataset/{self.id}"
             headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
-            r = requests.patch(url, data=json.dumps(payload), headers=headers)
+            r = transport.patch(url, data=json.dumps(payload), headers=headers)
         except:
             raise ValueError(f'Dataset update failed.')
         if r.status_code == 200:
@@ -179,7 +403,9 @@ class Dataset:
         else:
             pass
             return None
-        self.attributes = self.get_dataset()
+        invalidate_entity(self.server, 'dataset', self.id)
+        self.hydrate(self.get_dataset(fresh=True))
+        identity_map.add(self)
         return self
 
     def confirm_delete(self):
@@ -224,12 +450,13 @@ class Dataset:
             try:
                 url = f'{self.server}/dataset/{self.id}'
                 headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json', 'Cache-Control': 'no-cache'}
-                r = requests.delete(url, headers=headers)
+                r = transport.delete(url, headers=headers)
             except:
                 raise ValueError(f'Dataset deletion failed.')
             if r.status_code == 200:
                 print(r.url)
                 print('Deletion successful!')
+                invalidate_entity(self.server, 'dataset', self.id)
                 self = None
             else:
                 raise ValueError(f'Dataset deletion unsuccessful. {r.status_code}')
@@ -270,7 +497,7 @@ class Dataset:
             print(f'Creating clone dataset')
             url = f'{clone_server}/dataset'
             headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json', 'Cache-Control': 'no-cache'}
-            r = requests.post(url, data=json.dumps(payload), headers=headers)
+            r = transport.post(url, data=json.dumps(payload), headers=headers)
             if r.status_code == 200:
                 clone_dataset_id = r.json()['data']['id']
                 clone_dataset = Dataset(id_hash=clone_dataset_id, server=clone_server)
@@ -358,7 +585,7 @@ class Dataset:
         sql = f"SELECT ST_SUMMARYSTATS() from {self.attributes.get('tableName')}"
         params = {"sql": sql,
                   "geostore": geometry.id}
-        r = requests.get(url, params=params)
+        r = transport.get(url, params=params)
         if r.status_code == 200:
             try:
                 return r.json().get('data', [{}])[0].get('st_summarystats', None)
@@ -389,7 +616,7 @@ class Dataset:
             url_args = "metadata,layer"
         try:
             url = f"{self.server}/v1/dataset/{self.id}?includes={url_args}"
-            r = requests.get(url)
+            r = transport.get(url)
             dataset_config = r.json()['data']
         except:
             raise ValueError(f'Could not retrieve config.')
@@ -453,12 +680,14 @@ class Dataset:
             try:
                 url = f'{self.server}/v1/dataset/{ds_id}/vocabulary/{vocab_type}'
                 headers = {'Authorization': 'Bearer ' + token, 'Content-Type': 'application/json'}
-                r = requests.post(url, data=json.dumps(payload), headers=headers)
+                r = transport.post(url, data=json.dumps(payload), headers=headers)
             except:
                 raise ValueError(f'Vocabulary creation failed.')
             if r.status_code == 200:
                 print(f'Vocabulary {vocab_type} created.')
-                self.attributes = self.get_dataset()
+                invalidate_entity(self.server, 'dataset', self.id)
+                self.hydrate(self.get_dataset(fresh=True))
+                identity_map.add(self)
                 return self
             else:
                 print(f'Failed with error code {r.status_code}')
@@ -490,12 +719,14 @@ class Dataset:
             try:
                 url = f'{self.server}/v1/dataset/{ds_id}/metadata'
                 headers = {'Authorization': 'Bearer ' + token, 'Content-Type': 'application/json'}
-                r = requests.post(url, data=json.dumps(payload), headers=headers)
+                r = transport.post(url, data=json.dumps(payload), headers=headers)
             except:
                 raise ValueError(f'Vocabulary creation failed.')
             if r.status_code == 200:
                 print(f'Metadata created.')
-                self.attributes = self.get_dataset()
+                invalidate_entity(self.server, 'dataset', self.id)
+                self.hydrate(self.get_dataset(fresh=True))
+                identity_map.add(self)
                 return self
             else:
                 print(f'Failed with error code {r.status_code}')
@@ -531,13 +762,15 @@ class Dataset:
                 url = f'{self.server}/v1/dataset/{ds_id}/widget'
                 print(url)
                 headers = {'Authorization': 'Bearer ' + token, 'Content-Type': 'application/json'}
-                r = requests.post(url, data=json.dumps(payload), headers=headers)
+                r = transport.post(url, data=json.dumps(payload), headers=headers)
                 print(r.json())
             except:
                 raise ValueError(f'Widget creation failed.')
             if r.status_code == 200:
                 print(f'Widget created.')
-                self.attributes = self.get_dataset()
+                invalidate_entity(self.server, 'dataset', self.id)
+                self.hydrate(self.get_dataset(fresh=True))
+                identity_map.add(self)
                 return self
             else:
                 print(f'Failed with error code {r.status_code}')
@@ -558,7 +791,7 @@ class Dataset:
             headers = {'Authorization': 'Bearer ' + token, 'Content-Type': 'application/json', 'Cache-Control': 'no-cache'}
             payload = {'dataset': attributes}
 
-            r = requests.post(url, data=json.dumps(payload), headers=headers)
+            r = transport.post(url, data=json.dumps(payload), headers=headers)
             if r.status_code == 200:
                 new_dataset_id = r.json()['data']['id']
             else:
@@ -1,12 +1,12 @@
-import requests
 import folium
 import urllib
 import json
-import random
 import geopandas as gpd
 from shapely.geometry import shape
 import shapely.wkt
 import geojson
+from . import transport
+from .cache import load_entity, store_entity
 from .utils import html_box, get_geojson_string
 import json
 
@@ -100,7 +100,7 @@ class Geometry:
                 'Content-Type':'application/json'
                 }
         url = server + url
-        r = requests.get(url, headers=header)
+        r = transport.get(url, headers=header)
         if r.status_code == 200:
             self.server = server
             return r.json().get('data').get('id')
@@ -120,22 +120,30 @@ class Geometry:
                 'Content-Type':'application/json'
                 }
         url = self.server + '/v1/geostore'
-        r = requests.post(url, headers=header, json=body)
+        r = transport.post(url, headers=header, json=body)
         if r.status_code == 200:
             self.id = r.json().get('data').get('id')
             return r.json().get('data').get('attributes')
         else:
             raise ValueError(f'Recieved response of {r.status_code} from {r.url} when posting to geostore.')
 
-    def get_geometry(self, simplify=False, version='v2'):
+    def get_geometry(self, simplify=False, version='v2', fresh=False):
         """
         Returns a geostore object by ID from a Vizzuality endpoint.
+
+        Set fresh=True to bypass the response and entity caches and force a full download.
         """
-        hash = random.getrandbits(16)
-        url = (f'{self.server}/{version}/geostore/{self.id}?simplify={simplify}&hash={hash}')
-        r = requests.get(url)
+        includes = f'{version},simplify={simplify}'
+        if not fresh:
+            cached = load_entity(self.server, 'geometry', self.id, includes)
+            if cached is not None:
+                return cached
+        url = (f'{self.server}/{version}/geostore/{self.id}?simplify={simplify}')
+        r = transport.get(url, fresh=fresh)
         if r.status_code == 200:
-            return r.json().get('data').get('attributes')
+            attributes = r.json().get('data').get('attributes')
+            store_entity(self.server, 'geometry', self.id, includes, attributes)
+            return attributes
         else:
             raise ValueError(f'Unable to get dataset {self.id} from {r.url}')
 
@@ -176,7 +184,7 @@ class Geometry:
                   "band_viz": json.dumps(band_viz)
                   }
         url = "https://production-api.globalforestwatch.org/v1/recent-tiles"
-        r = requests.get(url, params=params)
+        r = transport.get(url, params=params)
         if r.status_code == 200:
             tile_url = r.json().get('data').get('tiles')[0].get('attributes').get('tile_url')
             return tile_url
@@ -194,7 +202,7 @@ class Geometry:
                      }
             url = "/v1/composite-service"
             url = self.server + url
-            r = requests.get(url, params=params)
+            r = transport.get(url, params=params)
             if r.status_code == 200:
                 tile_url = r.json().get('attributes').get('tile_url')
                 return tile_url
@@ -210,7 +218,7 @@ class Geometry:
                         'Content-Type': "application/json",
                         'cache-control': "no-cache",
                         }
-            r = requests.request("POST", url, data=payload, headers=headers, params=params)
+            r = transport.request("POST", url, data=payload, headers=headers, params=params)
             if r.status_code == 200:
                 tile_url = r.json().get('attributes').get('tile_url')
                 return tile_url
@@ -292,7 +300,7 @@ class Geometry:
                       "app": app}
             url = "/v1/geodescriber"
             url = self.server + url
-            r = requests.get(url, params=params)
+            r = transport.get(url, params=params)
             if r.status_code == 200:
                 d = {'title': r.json().get('data').get('title'),
                      'description': r.json().get('data').get('description'),
@@ -312,7 +320,7 @@ class Geometry:
                         'Content-Type': "application/json",
                         'cache-control': "no-cache",
                         }
-            r = requests.request("POST", url, data=payload, headers=headers, params=querystring)
+            r = transport.request("POST", url, data=payload, headers=headers, params=querystring)
             if r.status_code == 200:
                 d = {'title': r.json().get('data').get('title'),
                      'description': r.json().get('data').get('description'),
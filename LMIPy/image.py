@@ -1,5 +1,5 @@
+from . import transport
 from .utils import html_box, get_geojson_string
-import requests
 import json
 import folium
 import numpy as np
@@ -75,7 +75,7 @@ class Image:
     def get_thumbs(self):
         payload = {'source_data': [{'source': self.source}], 'bands': self.band_viz.get('bands')}
         url = self.server + '/recent-tiles/thumbs'
-        r = requests.post(url, data=json.dumps(payload), headers={'Content-Type': 'application/json'})
+        r = transport.post(url, data=json.dumps(payload), headers={'Content-Type': 'application/json'})
         if  r.status_code == 200:
             return r.json().get('data').get('attributes')[0].get('thumbnail_url')
         else:
@@ -85,7 +85,7 @@ class Image:
     def get_image_url(self):
         payload = {'source_data': [{'source': self.source}], 'bands': self.band_viz.get('bands')}
         url = self.server + '/recent-tiles/tiles'
-        r = requests.post(url, data=json.dumps(payload), headers={'Content-Type': 'application/json'})
+        r = transport.post(url, data=json.dumps(payload), headers={'Content-Type': 'application/json'})
         if  r.status_code == 200:
             return r.json().get('data').get('attributes')[0].get('tile_url')
         else:
@@ -156,7 +156,7 @@ class Image:
                 raise ValueError(f'Unable to perform {model_type} classification on a {self.type}.')
             url = self.server + '/recent-tiles-classifier'
             params = {'img_id': self.attributes.get('provider')}
-            r = requests.get(url, params=params)
+            r = transport.get(url, params=params)
             if r.status_code == 200:
                 classified_tiles = r.json().get('data').get('attributes').get('url')
                 tmp = {'instrument': self.instrument,
@@ -184,7 +184,7 @@ class Image:
                         'model_version': None}
             url = f'https://us-central1-skydipper-196010.cloudfunctions.net/classify'
             headers = {'Content-Type': 'application/json'}
-            r = requests.post(url, data=json.dumps(payload), headers=headers)
+            r = transport.post(url, data=json.dumps(payload), headers=headers)
             if r.status_code == 200:
                 image = np.array(r.json().get('output'), dtype=np.uint8)
                 hash_code = random.getrandbits(128)
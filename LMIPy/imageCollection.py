@@ -1,5 +1,5 @@
-import requests
 import json
+from . import transport
 from .image import Image
 from .utils import create_class, show_image_collection, flatten_list
 
@@ -90,7 +90,7 @@ class ImageCollection:
                   'lat':self.lat,
                   'start':self.start,
                   'end':self.end}
-        r = requests.get(url=url, params=params)
+        r = transport.get(url=url, params=params)
         if(r.status_code != 200):
             raise ValueError(f'Bad response from recent-tiles service: {r.status_code}, {r.json()}')
         try:
@@ -111,7 +111,7 @@ class ImageCollection:
             source_list = [{'source': item.get('source')} for item in image_list]
             payload = {'source_data': source_list, 'bands': self.band_viz.get('bands')}
             url = self.server + '/recent-tiles/thumbs'
-            r2 = requests.post(url, data=json.dumps(payload), headers={'Content-Type': 'application/json'})
+            r2 = transport.post(url, data=json.dumps(payload), headers={'Content-Type': 'application/json'})
             if r2.status_code == 200:
                 for n, item in enumerate(r2.json().get('data').get('attributes')):
                     image_list[n]['thumb_url'] = item.get('thumbnail_url')
@@ -150,7 +150,7 @@ class ImageCollection:
                   'end': self.end}
         url = f'https://us-central1-skydipper-196010.cloudfunctions.net/composite'
         headers = {'Content-Type': 'application/json'}
-        r = requests.post(url, data=json.dumps(payload), headers=headers)
+        r = transport.post(url, data=json.dumps(payload), headers=headers)
         if r.status_code == 200:
             tmp = {'instrument': instrument,
                     'date_time': f'{self.start}–{self.end}',
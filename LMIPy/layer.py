@@ -1,12 +1,12 @@
-import requests
 import geopandas as gpd
 import folium
 import urllib
 import json
-import random
 import re
 from pprint import pprint
-from .utils import html_box, get_geojson_string, nested_set, server_uses_widgets
+from . import transport
+from .cache import load_entity, store_entity, invalidate_entity, identity_map, cached_query
+from .utils import html_box, get_geojson_string, nested_set, server_uses_widgets, is_payload, fetch_many, decode_geometries
 
 
 class Layer:
@@ -21,21 +21,71 @@ class Layer:
         A dictionary holding the attributes of a dataset.
     server: str
         A string of the server URL.
+    lazy: bool
+        If True, only the id and server are recorded on construction, and the layer
+        is fetched on first access to its attributes.
+
+    If `attributes` is a full layer payload (e.g. one embedded in a dataset response)
+    the Layer is built from it without another request.
+
+    Constructing a Layer by id returns the already loaded instance when the
+    same id on the same server was constructed before in this process. Constructing
+    it from a payload updates that instance with the payload.
     """
+    def __new__(cls, id_hash=None, attributes=None, server='https://api.resourcewatch.org', *args, **kwargs):
+        if id_hash and (not attributes or is_payload(attributes, 'layer')):
+            existing = identity_map.get(server, cls.__name__.lower(), id_hash)
+            if existing is not None:
+                return existing
+        return super().__new__(cls)
+
     def __init__(self, id_hash=None, attributes=None,
-                    server='https://api.resourcewatch.org', mapbox_token=None, token=None):
+                    server='https://api.resourcewatch.org', mapbox_token=None, token=None, lazy=False):
+        if '_identity' in self.__dict__:
+            if mapbox_token:
+                self.mapbox_token = mapbox_token
+            if is_payload(attributes, 'layer'):
+                current = self.__dict__.get('attributes') or {}
+                kept = {k: current[k] for k in ['vocabulary', 'metadata'] if k in current}
+                self.attributes = {**kept, **attributes.get('attributes')}
+                self._lazy = False
+            return
         self.server = server
         self.mapbox_token = mapbox_token
-        if not attributes and id_hash:
+        if not attributes and id_hash and lazy:
+            self.id = id_hash
+            self._lazy = True
+        elif not attributes and id_hash:
             self.id = id_hash
             self.attributes = self.get_layer()
         elif attributes and token:
             created_layer = self.new_layer(token=token, attributes=attributes, server=self.server)
             self.attributes = created_layer.attributes
             self.id = created_layer.id
+        elif is_payload(attributes, 'layer'):
+            self.id = attributes.get('id')
+            self.attributes = attributes.get('attributes')
         elif attributes:
             self.id = attributes.get('id')
             self.attributes = self.get_layer()
+        identity_map.add(self)
+
+    def __getattr__(self, name):
+        if name == 'attributes' and self.__dict__.get('_lazy'):
+            self.attributes = self.get_layer()
+            self._lazy = False
+            return self.attributes
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    @classmethod
+    def get_many(cls, ids, server='https://api.resourcewatch.org', workers=8):
+        """
+        Fetch many layers by id.
+
+        Returns a tuple of (layers, errors): the layers in the order of `ids`, with None
+        where a lookup failed, and a dictionary of the errors keyed by id.
+        """
+        return fetch_many(cls, ids, server, 'layer', workers=workers)
 
     def __repr__(self):
         return self.__str__()
@@ -46,21 +96,32 @@ class Layer:
     def _repr_html_(self):
         return html_box(item=self)
 
-    def get_layer(self):
+    def get_layer(self, fresh=False):
         """
         Returns a layer from a Vizzuality API.
+
+        Parameters
+        ----------
+        fresh: bool
+            If True, bypass the response and entity caches and force a full download.
         """
+        if server_uses_widgets(self.server):
+            includes = 'vocabulary,metadata'
+        else:
+            includes = 'metadata'
+        if not fresh:
+            cached = load_entity(self.server, 'layer', self.id, includes)
+            if cached is not None:
+                return cached
         try:
-            hash = random.getrandbits(16)
-            if server_uses_widgets(self.server):
-                url = f'{self.server}/v1/layer/{self.id}?includes=vocabulary,metadata&hash={hash}'
-            else:
-                url = f'{self.server}/v1/layer/{self.id}?includes=metadata&hash={hash}'
-            r = requests.get(url)
+            url = f'{self.server}/v1/layer/{self.id}?includes={includes}'
+            r = transport.get(url, fresh=fresh)
         except:
             raise ValueError(f'Unable to get Layer {self.id} from {r.url}')
         if r.status_code == 200:
-            return r.json().get('data').get('attributes')
+            attributes = r.json().get('data').get('attributes')
+            store_entity(self.server, 'layer', self.id, includes, attributes)
+            return attributes
         else:
             raise ValueError(f'Layer with id={self.id} does not exist for server={self.server}.')
 
@@ -135,7 +196,7 @@ class Layer:
         }))
         apiParams = f"?stat_tag=API&config={_layerTpl}"
         url = f"https://{layerConfig.get('account')}.carto.com/api/v1/map{apiParams}"
-        r = requests.get(url, headers={'Content-Type': 'application/json'})
+        r = transport.get(url, headers={'Content-Type': 'application/json'})
         if r.status_code == 200:
             response = r.json()
         else:
@@ -151,7 +212,7 @@ class Layer:
         if vector_target and vector_target.lower() == 'mapbox':
             vector_source = layerConfig['body'].get('url', '').split('mapbox://')[1]
             url = f"https://api.mapbox.com/v4/{vector_source}.json?secure&access_token={self.mapbox_token}"
-            r = requests.get(url, headers={'Content-Type': 'application/json'})
+            r = transport.get(url, headers={'Content-Type': 'application/json'})
             if r.status_code == 200:
                 return r.json().get('tiles', [None])[0].replace('vector.pbf', 'png')
             else:
@@ -251,7 +312,7 @@ class Layer:
         try:
             url = f"{self.server}/dataset/{self.attributes['dataset']}/layer/{self.id}"
             headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
-            r = requests.patch(url, data=json.dumps(payload), headers=headers)
+            r = transport.patch(url, data=json.dumps(payload), headers=headers)
         except:
             raise ValueError(f'Layer update failed.')
         if r.status_code == 200:
@@ -259,7 +320,10 @@ class Layer:
         else:
             print(f"PATCH attempt threw a {r.status_code}!")
             return None
-        self.attributes = self.get_layer()
+        invalidate_entity(self.server, 'layer', self.id)
+        invalidate_entity(self.server, 'dataset', self.attributes.get('dataset'))
+        self.attributes = self.get_layer(fresh=True)
+        identity_map.add(self)
         return self
 
     def confirm_delete(self):
@@ -287,12 +351,14 @@ class Layer:
             try:
                 url = f'{self.server}/dataset/{self.attributes["dataset"]}/layer/{self.id}'
                 headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json', 'Cache-Control': 'no-cache'}
-                r = requests.delete(url, headers=headers)
+                r = transport.delete(url, headers=headers)
             except:
                 raise ValueError(f'Layer deletion failed.')
             if r.status_code == 200:
                 print(r.url)
                 print('Deletion successful!')
+                invalidate_entity(self.server, 'layer', self.id)
+                invalidate_entity(self.server, 'dataset', self.attributes.get('dataset'))
                 self = None
         else:
             print('Deletion aborted')
@@ -336,7 +402,7 @@ class Layer:
             print(f'Creating clone dataset')
             url = f'{clone_server}/dataset'
             headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json', 'Cache-Control': 'no-cache'}
-            r = requests.post(url, data=json.dumps(payload), headers=headers)
+            r = transport.post(url, data=json.dumps(payload), headers=headers)
             print(r.url)
             pprint(payload)
             if r.status_code == 200:
@@ -361,7 +427,7 @@ class Layer:
         print(f'Creating clone layer on target dataset')
         url = f'{clone_server}/dataset/{target_dataset_id}/layer'
         headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json', 'Cache-Control': 'no-cache'}
-        r = requests.post(url, data=json.dumps(payload), headers=headers)
+        r = transport.post(url, data=json.dumps(payload), headers=headers)
         if r.status_code == 200:
                 clone_layer_id = r.json()['data']['id']
         else:
@@ -412,9 +478,9 @@ class Layer:
         account = layerConfig.get('account')
         urlCarto = f"https://{account}.carto.com/api/v2/sql"
         params = {"q": sql}
-        r = requests.get(urlCarto, params=params)
+        r = transport.get(urlCarto, params=params)
         if r.status_code == 200:
-            return gpd.GeoDataFrame(r.json().get('rows'))
+            return decode_geometries(r.json().get('rows') or [])
         else:
             print(f'{r.url}')
             raise ValueError(f"Bad response from Carto {r.status_code}: {r.json()}")
@@ -423,7 +489,8 @@ class Layer:
         """
         Intersect layer against some geometry class object, geosjon object, shapely shape, or by id.
         """
-        return self.parse_query(sql=sql)
+        return cached_query(self.server, self.attributes.get('dataset'), f'layer {self.id}: {sql}',
+                            lambda: self.parse_query(sql=sql))
 
     def dataset(self):
         """
@@ -450,7 +517,7 @@ class Layer:
         sql = f"SELECT ST_SUMMARYSTATS() from {self.attributes.get('layerConfig').get('assetId')}"
         params = {"sql": sql,
                   "geostore": geometry.id}
-        r = requests.get(url, params=params)
+        r = transport.get(url, params=params)
         if r.status_code == 200:
             try:
                 return r.json().get('data', None)[0].get('st_summarystats')
@@ -512,7 +579,7 @@ class Layer:
             headers = {'Authorization': 'Bearer ' + token, 'Content-Type': 'application/json', 'Cache-Control': 'no-cache'}
             payload = {**attributes}
 
-            r = requests.post(url, data=json.dumps(payload), headers=headers)
+            r = transport.post(url, data=json.dumps(payload), headers=headers)
             if r.status_code == 200:
                 new_layer_id = r.json()['data']['id']
             else:
@@ -1,7 +1,7 @@
-import requests
-import random
 import json
-from .utils import html_box, nested_set
+from . import transport
+from .cache import load_entity, store_entity, invalidate_entity, identity_map
+from .utils import html_box, nested_set, is_payload, fetch_many
 
 
 class Metadata:
@@ -52,11 +52,12 @@ class Metadata:
                 url = f'{self.server}/v1/dataset/{ds_id}/metadata'
                 print('url',url)
                 headers = {'Authorization': 'Bearer ' + token, 'Content-Type': 'application/json'}
-                r = requests.patch(url, data=json.dumps(payload), headers=headers)
+                r = transport.patch(url, data=json.dumps(payload), headers=headers)
             except:
                 raise ValueError(f'Metadata update failed.')
             if r.status_code == 200:
                 print(f'Metadata updated.')
+                invalidate_entity(self.server, 'dataset', ds_id)
                 return Dataset(id_hash=ds_id, server=self.server).metadata
             else:
                 print(f'Failed with error code {r.status_code}')
@@ -78,11 +79,12 @@ class Metadata:
             try:
                 url = f'{self.server}/dataset/{ds_id}/metadata?application={app}&language={lang}'
                 headers = {'Authorization': 'Bearer ' + token, 'Content-Type': 'application/json', 'Cache-Control': 'no-cache'}
-                r = requests.delete(url, headers=headers)
+                r = transport.delete(url, headers=headers)
             except:
                 raise ValueError(f'Metdata deletion failed.')
             if r.status_code == 200:
                 print(f'Metdata deleted.')
+                invalidate_entity(self.server, 'dataset', ds_id)
         return None
 
 class Vocabulary:
@@ -136,11 +138,12 @@ class Vocabulary:
             try:
                 url = f'{self.server}/dataset/{ds_id}/vocabulary/{vocab_type}?app={app}'
                 headers = {'Authorization': 'Bearer ' + token, 'Content-Type': 'application/json', 'Cache-Control': 'no-cache'}
-                r = requests.delete(url, headers=headers)
+                r = transport.delete(url, headers=headers)
             except:
                 raise ValueError(f'Vocabulary deletion failed.')
             if r.status_code == 200:
                 print(f'Vocabulary {vocab_type} deleted.')
+                invalidate_entity(self.server, 'dataset', ds_id)
         return None
 
 class Widget:
@@ -151,11 +154,37 @@ class Widget:
     ----------
     attributes: dic
         A dictionary holding the attributes of a widget (which are attached to a Dataset).
+        If it is a full widget payload (e.g. one embedded in a dataset response) the
+        Widget is built from it without another request.
+    lazy: bool
+        If True, only the id and server are recorded on construction, and the widget
+        is fetched on first access to its attributes.
+
+    Constructing a Widget by id returns the already loaded instance when the
+    same id on the same server was constructed before in this process. Constructing
+    it from a payload updates that instance with the payload.
     """
-    def __init__(self, id_hash=None, attributes=None, server='https://api.resourcewatch.org'):
+    def __new__(cls, id_hash=None, attributes=None, server='https://api.resourcewatch.org', *args, **kwargs):
+        if id_hash:
+            existing = identity_map.get(server, cls.__name__.lower(), id_hash)
+            if existing is not None:
+                return existing
+        return super().__new__(cls)
+
+    def __init__(self, id_hash=None, attributes=None, server='https://api.resourcewatch.org', lazy=False):
+        if '_identity' in self.__dict__:
+            if is_payload(attributes, 'widget'):
+                self.attributes = attributes.get('attributes')
+                self._lazy = False
+            return
         self.id = id_hash
         self.server = server
-        if id_hash:
+        if is_payload(attributes, 'widget'):
+            self.id = attributes.get('id')
+            self.attributes = attributes.get('attributes')
+        elif id_hash and lazy:
+            self._lazy = True
+        elif id_hash:
             self.attributes = self.get_widget()
         elif attributes:
             self.id = attributes.get('id')
@@ -163,6 +192,24 @@ class Widget:
 
         else:
             raise ValueError(f'Unable to initialise Widget without id_hash.')
+        identity_map.add(self)
+
+    def __getattr__(self, name):
+        if name == 'attributes' and self.__dict__.get('_lazy'):
+            self.attributes = self.get_widget()
+            self._lazy = False
+            return self.attributes
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    @classmethod
+    def get_many(cls, ids, server='https://api.resourcewatch.org', workers=8):
+        """
+        Fetch many widgets by id.
+
+        Returns a tuple of (widgets, errors): the widgets in the order of `ids`, with None
+        where a lookup failed, and a dictionary of the errors keyed by id.
+        """
+        return fetch_many(cls, ids, server, 'widget', workers=workers)
 
     def __repr__(self):
         return self.__str__()
@@ -173,19 +220,29 @@ class Widget:
     def __str__(self):
         return f"Widget {self.id} {self.attributes.get('name','')}"
 
-    def get_widget(self):
+    def get_widget(self, fresh=False):
         """
         Returns a widget from a Vizzuality API.
+
+        Parameters
+        ----------
+        fresh: bool
+            If True, bypass the response and entity caches and force a full download.
         """
+        if not fresh:
+            cached = load_entity(self.server, 'widget', self.id)
+            if cached is not None:
+                return cached
         try:
-            hash = random.getrandbits(16)
-            url = (f'{self.server}/v1/widget/{self.id}?hash={hash}')
-            r = requests.get(url)
+            url = (f'{self.server}/v1/widget/{self.id}')
+            r = transport.get(url, fresh=fresh)
         except:
             raise ValueError(f'Unable to get Widget {self.id} from {r.url}')
 
         if r.status_code == 200:
-            return r.json().get('data').get('attributes')
+            attributes = r.json().get('data').get('attributes')
+            store_entity(self.server, 'widget', self.id, '', attributes)
+            return attributes
         else:
             raise ValueError(f'Widget with id={self.id} does not exist.')
 
@@ -219,12 +276,15 @@ class Widget:
                 url = f'{self.server}/v1/dataset/{ds_id}/widget/{w_id}'
                 print('url',url)
                 headers = {'Authorization': 'Bearer ' + token, 'Content-Type': 'application/json'}
-                r = requests.patch(url, data=json.dumps(payload), headers=headers)
+                r = transport.patch(url, data=json.dumps(payload), headers=headers)
             except:
                 raise ValueError(f'Widget update failed.')
             if r.status_code == 200:
                 print(f'Widget updated.')
-                self.attributes = self.get_widget()
+                invalidate_entity(self.server, 'widget', w_id)
+                invalidate_entity(self.server, 'dataset', ds_id)
+                self.attributes = self.get_widget(fresh=True)
+                identity_map.add(self)
                 return self
             else:
                 print(f'Failed with error code {r.status_code}')
@@ -244,11 +304,13 @@ class Widget:
         try:
             url = f'{self.server}/dataset/{ds_id}/widget/{w_id}'
             headers = {'Authorization': 'Bearer ' + token, 'Content-Type': 'application/json', 'Cache-Control': 'no-cache'}
-            r = requests.delete(url, headers=headers)
+            r = transport.delete(url, headers=headers)
         except:
             raise ValueError(f'Widget deletion failed.')
         if r.status_code == 200:
             print(f'Widget deleted.')
+            invalidate_entity(self.server, 'widget', w_id)
+            invalidate_entity(self.server, 'dataset', ds_id)
         return None
 
     def save(self, path=None):
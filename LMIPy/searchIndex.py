@@ -0,0 +1,122 @@
+from collections import defaultdict
+
+
+def query_terms(query):
+    """
+    Returns the search terms of a query: the whole query and each of its words.
+    """
+    return [query.lower()] + query.lower().strip().split(' ')
+
+def searchable_fields(record):
+    """
+    Returns the lower-cased name, description, slug tokens and vocabulary tags of a
+    collection record.
+    """
+    attributes = record.get('attributes') or {}
+    name = (attributes.get('name') or '').lower()
+    description = (attributes.get('description') or '').lower()
+    slug = (attributes.get('slug') or '').lower()
+    slug_tokens = slug.split('_') if slug else []
+    tags = []
+    for vocabulary in attributes.get('vocabulary') or []:
+        tags += [str(t).lower() for t in (vocabulary.get('attributes') or {}).get('tags') or []]
+    return name, description, slug_tokens, tags
+
+def matches(record, terms):
+    """
+    Does a record match any of the search terms? A term matches if it is contained in
+    the name or description, or equals a slug token or vocabulary tag.
+    """
+    name, description, slug_tokens, tags = searchable_fields(record)
+    found = []
+    for text in (description, name):
+        if text:
+            found.append(any([s in text for s in terms]))
+    for tokens in (slug_tokens, tags):
+        if tokens:
+            found.append(any([s in tokens for s in terms]))
+    return any(found)
+
+
+class SearchIndex:
+    """
+    An in-memory inverted index of collection records for fast local text search.
+
+    Words of names and descriptions are indexed by their character n-grams, so that
+    any substring can be found without scanning every record; slug tokens and
+    vocabulary tags are indexed for exact matches. Search results are identical to
+    Collection's substring filtering.
+
+    Parameters
+    ----------
+    records: list
+        Collection records ({'type', 'id', 'attributes', 'server'}) to index.
+    n: int
+        Length of the character n-grams indexing each word.
+    """
+    def __init__(self, records=None, n=3):
+        self.n = n
+        self.records = []
+        self.words = defaultdict(set)
+        self.grams = defaultdict(set)
+        self.tokens = defaultdict(set)
+        for record in records or []:
+            self.add(record)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __repr__(self):
+        return f"SearchIndex {len(self.records)} records, {len(self.words)} words"
+
+    def add(self, record):
+        """Adds a record to the index."""
+        position = len(self.records)
+        name, description, slug_tokens, tags = searchable_fields(record)
+        self.records.append(record)
+        for word in set(name.split() + description.split()):
+            if word not in self.words:
+                for gram in self.ngrams(word):
+                    self.grams[gram].add(word)
+            self.words[word].add(position)
+        for token in set(slug_tokens + tags):
+            self.tokens[token].add(position)
+
+    def ngrams(self, word):
+        return {word[i:i + self.n] for i in range(max(1, len(word) - self.n + 1))}
+
+    def find_word(self, fragment):
+        """Returns the positions of records with a word containing the fragment."""
+        if len(fragment) >= self.n:
+            candidates = set.intersection(*[self.grams.get(g, set()) for g in self.ngrams(fragment)])
+        else:
+            candidates = self.words.keys()
+        positions = set()
+        for word in candidates:
+            if fragment in word:
+                positions |= self.words[word]
+        return positions
+
+    def find_term(self, term):
+        """Returns the positions of records matching a single search term."""
+        positions = set(self.tokens.get(term, set()))
+        fragments = term.split()
+        if fragments == [term] or not term:
+            return positions | self.find_word(term)
+        if not fragments:
+            return positions
+        candidates = set.intersection(*[self.find_word(f) for f in fragments])
+        for position in candidates:
+            name, description, _, _ = searchable_fields(self.records[position])
+            if term in name or term in description:
+                positions.add(position)
+        return positions
+
+    def search(self, query):
+        """
+        Returns the records matching a query, in the order they were added.
+        """
+        positions = set()
+        for term in set(query_terms(query)):
+            positions |= self.find_term(term)
+        return [self.records[p] for p in sorted(positions)]
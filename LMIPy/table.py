@@ -1,9 +1,9 @@
-import requests
-import random
-import geopandas as gpd
-from shapely.geometry import shape
+import re
+import itertools
+from . import transport
 from .dataset import Dataset
-from .utils import html_box
+from .cache import cached_query
+from .utils import html_box, decode_geometries, iter_prefetched, top_level_sql
 
 class Table(Dataset):
     """
@@ -17,9 +17,13 @@ class Table(Dataset):
         A dictionary holding the attributes of a tabular dataset.
     server: str
         A string of the server URL.
+    lazy: bool
+        If True, the table is only fetched on first access to its attributes.
+    includes: list
+        Relationships to fetch with the table, e.g. [] for core attributes only.
     """
-    def __init__(self, id_hash=None, attributes=None, server='https://api.resourcewatch.org'):
-        super().__init__(id_hash=id_hash, attributes=attributes, server=server)
+    def __init__(self, id_hash=None, attributes=None, server='https://api.resourcewatch.org', lazy=False, includes=None):
+        super().__init__(id_hash=id_hash, attributes=attributes, server=server, lazy=lazy, includes=includes)
 
     def __repr__(self):
         return self.__str__()
@@ -35,13 +39,9 @@ class Table(Dataset):
         sql = sql.replace('FROM data', f'FROM {table_name}')
         try:
             url = (f'{self.server}/v1/query/{self.id}?sql={sql}')
-            r = requests.get(url)
+            r = transport.get(url)
             if r.status_code == 200:
-                response_data = r.json().get('data')
-                for d in response_data:
-                    if d.get('the_geom', None):
-                        d['geometry'] = shape(d['the_geom'])
-                return response_data
+                return r.json().get('data')
             else:
                 raise ValueError(f'Unable to get table {self.id} from {r.url}')
         except:
@@ -59,14 +59,7 @@ class Table(Dataset):
             A flag to decode geometries into geom objects.
         """
         sql = f'SELECT * FROM data LIMIT {n}'
-        response_data = self.fetch_query(sql=sql)
-        try:
-            gdf = gpd.GeoDataFrame(response_data)
-            if 'geometry' in gdf:
-                gdf = gdf.set_geometry('geometry')
-            return gdf
-        except:
-            raise ValueError(f'Unable to get table {self.id}')
+        return cached_query(self.server, self.id, sql, lambda: self.decode_query(sql))
 
     def query(self, sql=None):
         """
@@ -82,11 +75,57 @@ class Table(Dataset):
         if not sql: sql = 'SELECT * FROM data LIMIT 5'
         if type(sql) != str:
             raise ValueError('SQL query should be passed as a string.')
+        return cached_query(self.server, self.id, sql, lambda: self.decode_query(sql))
+
+    def iter_query(self, sql="SELECT * FROM data", chunksize=10000, prefetch=2, order_by=None):
+        """
+        Yields the result of a query as GeoPandas GeoDataFrames of at most `chunksize`
+        rows, paging the query on the server with LIMIT/OFFSET while the next `prefetch`
+        pages are fetched concurrently. Queries with their own LIMIT are run in one page.
+
+        Pages only partition the result if it has a deterministic order, so the query
+        must end with an ORDER BY on unique columns, or give them as `order_by` (an
+        ORDER BY within a subquery or window doesn't order the result).
+
+        Parameters
+        ----------
+        sql: str
+            A valid SQL query e.g. 'SELECT * FROM data ORDER BY id'
+        chunksize: int
+            Maximum number of rows per GeoDataFrame.
+        prefetch: int
+            Number of pages fetched ahead of the one being used.
+        order_by: str
+            Unique column(s) the pages are ordered by, e.g. 'id', if the query has no ORDER BY.
+        """
+        sql = sql.strip().rstrip(';')
+        statement = top_level_sql(sql)
+        if re.search(r'\blimit\b', statement, re.IGNORECASE):
+            frame = self.decode_query(sql)
+            if len(frame):
+                yield frame
+            return
+        ordered = re.search(r'\border\s+by\b', statement, re.IGNORECASE)
+        if order_by and ordered:
+            raise ValueError('The query is already ordered, pass order_by only for queries without an ORDER BY')
+        elif order_by:
+            sql = f'{sql} ORDER BY {order_by}'
+        elif not ordered:
+            raise ValueError('Unable to page a query without an order, add an ORDER BY on unique columns '
+                             'or pass them as order_by')
+        pages = (f'{sql} LIMIT {chunksize} OFFSET {offset}' for offset in itertools.count(0, chunksize))
+        for frame in iter_prefetched(self.decode_query, pages, prefetch=prefetch):
+            if len(frame):
+                yield frame
+            if len(frame) < chunksize:
+                return
+
+    def decode_query(self, sql):
+        """
+        Returns the result of a query as a GeoDataFrame.
+        """
         response_data = self.fetch_query(sql=sql)
         try:
-            gdf = gpd.GeoDataFrame(response_data)
-            if 'geometry' in gdf:
-                gdf = gdf.set_geometry('geometry')
-            return gdf
+            return decode_geometries(response_data)
         except:
             raise ValueError(f'Unable to query table {self.id} with {sql}')
\ No newline at end of file
@@ -0,0 +1,216 @@
+import threading
+import requests
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+
+class ResponseCache:
+    """
+    An in-memory store of GET responses carrying an ETag or Last-Modified header.
+
+    Stored responses are revalidated with If-None-Match/If-Modified-Since, and
+    served from memory when the server answers 304 Not Modified. The least
+    recently used entries are dropped once more than `max_entries` are held or
+    their bodies exceed `max_bytes`; bodies larger than an eighth of `max_bytes`
+    are not stored.
+    """
+    def __init__(self, max_entries=512, max_bytes=32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, url):
+        with self._lock:
+            response = self.entries.get(url)
+            if response is not None:
+                self.entries.move_to_end(url)
+            return response
+
+    def set(self, url, response):
+        if not (response.headers.get('ETag') or response.headers.get('Last-Modified')):
+            return
+        if len(response.content) > self.max_bytes // 8:
+            return
+        with self._lock:
+            previous = self.entries.pop(url, None)
+            if previous is not None:
+                self.size -= len(previous.content)
+            self.entries[url] = response
+            self.size += len(response.content)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, dropped = self.entries.popitem(last=False)
+                self.size -= len(dropped.content)
+
+    def validators(self, url):
+        """
+        Returns the conditional request headers for a previously stored url.
+        """
+        response = self.get(url)
+        if response is None:
+            return {}
+        headers = {}
+        if response.headers.get('ETag'):
+            headers['If-None-Match'] = response.headers['ETag']
+        if response.headers.get('Last-Modified'):
+            headers['If-Modified-Since'] = response.headers['Last-Modified']
+        return headers
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class Transport:
+    """
+    A pool of keep-alive HTTP sessions shared by every LMIPy entity class.
+
+    One requests.Session is kept per server (scheme and host), so repeated calls
+    against the same API reuse open TCP/TLS connections instead of performing a
+    new handshake for every request.
+
+    Parameters
+    ----------
+    pool_size: int
+        Maximum number of connections kept open per server.
+    keep_alive: bool
+        If False, connections are closed after each request.
+    max_retries: int
+        Number of times a failed connection attempt is retried.
+    cache_size: int
+        Number of API entity responses kept for conditional revalidation (0 disables it).
+    cache_bytes: int
+        Maximum total size of the bodies of the cached responses.
+    """
+    def __init__(self, pool_size=10, keep_alive=True, max_retries=0, cache_size=512, cache_bytes=32 * 1024 * 1024):
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.max_retries = max_retries
+        self.cache = ResponseCache(max_entries=cache_size, max_bytes=cache_bytes) if cache_size else None
+        self.sessions = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"Transport pool_size={self.pool_size} keep_alive={self.keep_alive} servers={len(self.sessions)}"
+
+    def session(self, url):
+        """
+        Returns the pooled session serving the server of a given url.
+        """
+        parts = urlsplit(url)
+        key = f'{parts.scheme}://{parts.netloc}'
+        with self._lock:
+            session = self.sessions.get(key)
+            if not session:
+                session = requests.Session()
+                session.mount(f'{key}/', self._adapter())
+                if not self.keep_alive:
+                    session.headers['Connection'] = 'close'
+                self.sessions[key] = session
+        return session
+
+    def _adapter(self):
+        return HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=self.max_retries)
+
+    def set_pool_size(self, pool_size):
+        """
+        Changes the number of connections kept open per server, keeping cached responses.
+        """
+        with self._lock:
+            self.pool_size = pool_size
+            for key, session in self.sessions.items():
+                session.mount(f'{key}/', self._adapter())
+
+    def request(self, method, url, **kwargs):
+        return self.session(url).request(method, url, **kwargs)
+
+    def get(self, url, fresh=False, **kwargs):
+        """
+        Sends a GET request, revalidating any cached copy of the response.
+
+        Only reads of API entities (/v1/ urls other than queries) are cached. A 304
+        Not Modified answer is served from the response cache. Set fresh=True to
+        skip revalidation and force a full download.
+        """
+        headers = dict(kwargs.pop('headers', None) or {})
+        path = urlsplit(url).path
+        cacheable = (self.cache is not None and 'Authorization' not in headers and not kwargs.get('stream')
+                     and path.startswith('/v1/') and not path.startswith('/v1/query'))
+        if not cacheable:
+            return self.request('GET', url, headers=headers, **kwargs)
+        key = requests.Request('GET', url, params=kwargs.get('params')).prepare().url
+        if fresh:
+            headers['Cache-Control'] = 'no-cache'
+        else:
+            headers.update(self.cache.validators(key))
+        r = self.request('GET', url, headers=headers, **kwargs)
+        if r.status_code == 304:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+            headers.pop('If-None-Match', None)
+            headers.pop('If-Modified-Since', None)
+            r = self.request('GET', url, headers=headers, **kwargs)
+        if r.status_code == 200:
+            self.cache.set(key, r)
+        return r
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def close(self):
+        """
+        Closes all pooled connections.
+        """
+        with self._lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+        if self.cache is not None:
+            self.cache.clear()
+
+
+_transport = Transport()
+
+def get_transport():
+    """Returns the Transport currently shared by all LMIPy objects."""
+    return _transport
+
+def configure_transport(pool_size=10, keep_alive=True, max_retries=0, cache_size=512, cache_bytes=32 * 1024 * 1024):
+    """
+    Replaces the shared Transport with a new one using the given pool settings.
+    Connections held by the previous Transport are closed.
+    """
+    global _transport
+    previous = _transport
+    _transport = Transport(pool_size=pool_size, keep_alive=keep_alive, max_retries=max_retries, cache_size=cache_size,
+                           cache_bytes=cache_bytes)
+    previous.close()
+    return _transport
+
+def request(method, url, **kwargs):
+    return _transport.request(method, url, **kwargs)
+
+def get(url, fresh=False, **kwargs):
+    return _transport.get(url, fresh=fresh, **kwargs)
+
+def post(url, **kwargs):
+    return _transport.post(url, **kwargs)
+
+def patch(url, **kwargs):
+    return _transport.patch(url, **kwargs)
+
+def delete(url, **kwargs):
+    return _transport.delete(url, **kwargs)
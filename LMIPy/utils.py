@@ -1,4 +1,18 @@
+import os
+import re
 import json
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely import wkb
+from shapely.geometry import shape
+from pyproj import CRS
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from . import transport
 
 def html_box(item):
     """Returns an HTML block with template strings filled-in based on item attributes."""
@@ -197,23 +211,303 @@ def show(item, i):
             " </div> </div>")
     return html
 
-def create_class(item):
+def create_class(item, lazy=False, hydrate=False, includes=None):
+    """
+    Returns the LMIPy object described by a collection item. If lazy, the object is
+    only fetched from its server on first access to its attributes. If hydrate, the
+    attributes held by the item are used instead of fetching the object, with
+    `includes` the relationships fetched along with dataset attributes.
+    """
     from .dataset import Dataset
     from .table import Table
     from .layer import Layer
     from .lmipy import Widget
     from .image import Image
+    payload = None
+    if hydrate and item.get('attributes') and item['type'] in ['Table', 'Dataset', 'Layer', 'Widget']:
+        entity_type = 'dataset' if item['type'] == 'Table' else item['type'].lower()
+        payload = {'id': item.get('id'), 'type': entity_type, 'attributes': item.get('attributes')}
     if item['type'] == 'Table':
-        return Table(id_hash = item.get('id'), server = item.get('server'))
+        if payload:
+            return Table(id_hash = item.get('id'), attributes=payload, server = item.get('server'), includes=includes)
+        return Table(id_hash = item.get('id'), server = item.get('server'), lazy=lazy)
     elif item['type'] == 'Dataset':
-        return Dataset(id_hash = item.get('id'), server = item.get('server'))
+        if payload:
+            return Dataset(id_hash = item.get('id'), attributes=payload, server = item.get('server'), includes=includes)
+        return Dataset(id_hash = item.get('id'), server = item.get('server'), lazy=lazy)
     elif item['type'] == 'Layer':
-        return Layer(id_hash = item.get('id'), server = item.get('server'))
+        if payload:
+            return Layer(id_hash = item.get('id'), attributes=payload, server = item.get('server'),
+                         mapbox_token=item.get('mapbox_token'))
+        return Layer(id_hash = item.get('id'), server = item.get('server'), lazy=lazy)
     elif item['type'] == 'Widget':
-        return Widget(id_hash = item.get('id'), attributes=item.get('attributes'), server = item.get('server'))
+        return Widget(id_hash = item.get('id'), attributes=payload or item.get('attributes'), server = item.get('server'), lazy=lazy)
     elif item['type'] == 'Image':
         return Image(**item)
 
+def is_payload(attributes, entity_type):
+    """
+    Is `attributes` a full API payload ({'id', 'type', 'attributes'}) of the given entity type,
+    e.g. a layer embedded in a dataset response? If so it can be used without refetching.
+    """
+    return (isinstance(attributes, dict) and attributes.get('type') == entity_type
+            and isinstance(attributes.get('attributes'), dict))
+
+def map_concurrently(func, items, workers=8, return_exceptions=False):
+    """
+    Calls func on every item using a bounded pool of worker threads and returns the
+    results in input order. If return_exceptions, errors are returned in place of
+    results rather than raised.
+    """
+    def call(item):
+        try:
+            return func(item)
+        except Exception as e:
+            if return_exceptions:
+                return e
+            raise
+    items = list(items)
+    if len(items) <= 1 or workers <= 1:
+        return [call(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        return list(executor.map(call, items))
+
+def iter_prefetched(func, items, prefetch=2):
+    """
+    Yields func(item) for each item in order, while the next `prefetch` calls run on
+    background threads. Calls not yet started are cancelled if iteration stops early.
+    """
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=max(1, prefetch))
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) > max(1, prefetch):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+def find_by_ids(server, entity_type, ids, params=None, chunk_size=100):
+    """
+    Looks up many entities at once with the API's find-by-ids endpoint. Returns a
+    dictionary of payloads by id, or None if the endpoint is unavailable.
+    """
+    found = {}
+    for n in range(0, len(ids), chunk_size):
+        try:
+            r = transport.post(f'{server}/v1/{entity_type}/find-by-ids', params=params,
+                               json={'ids': ids[n:n + chunk_size]})
+        except Exception:
+            return None
+        if r.status_code != 200:
+            return None
+        for item in r.json().get('data') or []:
+            found[item.get('id')] = item
+    return found
+
+def fetch_many(cls, ids, server, entity_type, workers=8, params=None, **kwargs):
+    """
+    Returns (objects, errors) for a list of ids: objects of class cls in input order (None
+    where the lookup failed) and a dictionary of errors by id. Entities are looked up in
+    bulk where the server supports it, and otherwise with concurrent single requests.
+    """
+    ids = list(ids)
+    unique_ids = list(dict.fromkeys(ids))
+    found = find_by_ids(server, entity_type, unique_ids, params=params) or {}
+    def build(id_hash):
+        if id_hash in found:
+            return cls(id_hash=id_hash, attributes=found[id_hash], server=server, **kwargs)
+        return cls(id_hash=id_hash, server=server, **kwargs)
+    built = dict(zip(unique_ids, map_concurrently(build, unique_ids, workers=workers, return_exceptions=True)))
+    objects = []
+    errors = {}
+    for id_hash in ids:
+        if isinstance(built[id_hash], Exception):
+            objects.append(None)
+            errors[id_hash] = built[id_hash]
+        else:
+            objects.append(built[id_hash])
+    return objects, errors
+
+def atomic_write(path, data):
+    """
+    Writes a string to a file so that the file is either left untouched or fully
+    written, even if the process is interrupted.
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as fp:
+        fp.write(data)
+    os.replace(tmp_path, path)
+
+def decode_geometries(data, column='the_geom', crs='EPSG:4326'):
+    """
+    Returns a GeoDataFrame of query rows (a DataFrame or list of dicts) with the geometries
+    of `column`, as WKB (hex) or GeoJSON, decoded in a single vectorized pass into its
+    geometry column.
+    """
+    df = data if isinstance(data, pd.DataFrame) else pd.DataFrame(data)
+    if column not in df or not df[column].notna().any():
+        return gpd.GeoDataFrame(df)
+    values = np.array([v if isinstance(v, (str, bytes, dict)) else None for v in df[column]], dtype=object)
+    sample = next(v for v in values if v is not None)
+    if isinstance(sample, dict):
+        values = np.array([json.dumps(v) if v is not None else None for v in values], dtype=object)
+    if hasattr(shapely, 'from_wkb'):
+        decoders = [shapely.from_geojson, shapely.from_wkt] if isinstance(sample, dict) or str(sample).lstrip().startswith('{') \
+            else [shapely.from_wkb, shapely.from_wkt]
+    else:
+        decoders = [lambda a: [shape(json.loads(v)) if v else None for v in a]] if isinstance(sample, dict) \
+            else [lambda a: [wkb.loads(v, hex=True) if v else None for v in a]]
+    for n, decode in enumerate(decoders):
+        try:
+            geometries = decode(values)
+            break
+        except Exception:
+            if n == len(decoders) - 1:
+                raise ValueError(f'Unable to decode geometries of column {column}')
+    return gpd.GeoDataFrame(df, geometry=gpd.GeoSeries(geometries, index=df.index, crs=crs), crs=crs)
+
+def top_level_sql(sql):
+    """
+    Returns a SQL statement without its string literals, quoted identifiers and
+    parenthesized parts (subqueries, window definitions, function arguments), leaving
+    the clauses of the top-level statement.
+    """
+    sql = re.sub(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"", "''", sql)
+    previous = None
+    while previous != sql:
+        previous, sql = sql, re.sub(r'\([^()]*\)', '()', sql)
+    return sql
+
+def carto_dtypes(fields):
+    """
+    Returns the pandas dtypes of the fields of a CARTO SQL API result, and the names of
+    its date fields, to read its CSV export with. Integer columns are nullable Int64,
+    other numbers float64, and strings, geometries and unknown types strings.
+    """
+    dtypes, dates = {}, []
+    for name, field in fields.items():
+        if field.get('pgtype') in ['int2', 'int4', 'int8']:
+            dtypes[name] = 'Int64'
+        elif field.get('type') == 'number':
+            dtypes[name] = 'float64'
+        elif field.get('type') == 'boolean':
+            dtypes[name] = 'boolean'
+        elif field.get('type') == 'date':
+            dates.append(name)
+        else:
+            dtypes[name] = str
+    return dtypes, dates
+
+def import_pyarrow():
+    """Returns the pyarrow and pyarrow.parquet modules, needed for Parquet files."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Parquet files require pyarrow: pip install LMIPy[parquet]')
+    return pyarrow, pyarrow.parquet
+
+def frame_to_arrow(frame, column='the_geom'):
+    """
+    Returns a GeoDataFrame as a pyarrow Table, with its geometry column encoded as WKB
+    and described in GeoParquet 'geo' metadata. The raw geometry `column` of a query
+    is dropped once decoded, and a query page without any geometries in it gets an
+    empty geometry column, so that all the pages of a query have the same columns.
+    """
+    pa, _ = import_pyarrow()
+    decoded = isinstance(frame, gpd.GeoDataFrame) and frame._geometry_column_name in frame
+    if column in frame and not decoded:
+        frame = gpd.GeoDataFrame(frame, geometry=gpd.GeoSeries([None] * len(frame), index=frame.index, crs='EPSG:4326'))
+    geometry = frame._geometry_column_name if isinstance(frame, gpd.GeoDataFrame) else None
+    if geometry not in frame:
+        return pa.Table.from_pandas(pd.DataFrame(frame), preserve_index=False)
+    df = pd.DataFrame(frame.drop(columns=[column] if column != geometry and column in frame else []))
+    df[geometry] = None
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    wkb_values = pa.array(list(frame.geometry.to_wkb()), type=pa.binary())
+    table = table.set_column(table.schema.get_field_index(geometry), geometry, wkb_values)
+    spec = {'encoding': 'WKB', 'geometry_types': []}
+    if frame.crs is not None:
+        spec['crs'] = frame.crs.to_json_dict()
+    geo = {'version': '1.0.0', 'primary_column': geometry, 'columns': {geometry: spec}}
+    return table.replace_schema_metadata({**(table.schema.metadata or {}), b'geo': json.dumps(geo).encode()})
+
+def write_parquet(frames, path):
+    """
+    Writes an iterable of (Geo)DataFrames to a single Parquet file, holding only one
+    frame in memory at a time. Frames are spooled to temporary files next to `path`
+    until their column types are merged (e.g. a column empty in the first frames takes
+    the type of the later ones, integers are widened to floats); columns without any
+    value are stored as strings. Every frame must have the same columns. Geometries
+    are stored as GeoParquet. Returns the number of rows written.
+    """
+    pa, pq = import_pyarrow()
+    spool = tempfile.mkdtemp(prefix='.lmipy-', dir=os.path.dirname(os.path.abspath(path)))
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    parts, schemas, rows = [], [], 0
+    try:
+        for frame in frames:
+            table = frame_to_arrow(frame)
+            if schemas and set(table.schema.names) != set(schemas[0].names):
+                raise ValueError(f'Rows {rows}-{rows + len(frame)} have columns {", ".join(table.schema.names)}, '
+                                 f'not those of the first rows ({", ".join(schemas[0].names)})')
+            if schemas:
+                table = table.select(schemas[0].names)
+            parts.append(os.path.join(spool, f'{len(parts)}.parquet'))
+            pq.write_table(table, parts[-1])
+            schemas.append(table.schema)
+            rows += len(frame)
+        if not schemas:
+            pq.write_table(pa.table({}), tmp_path)
+        else:
+            try:
+                schema = pa.unify_schemas(schemas, promote_options='permissive')
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                raise ValueError('Columns of the rows have incompatible types, cast their types in the query')
+            geo = (schemas[0].metadata or {}).get(b'geo')
+            schema = pa.schema([pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f for f in schema],
+                               metadata={b'geo': geo} if geo else None)
+            with pq.ParquetWriter(tmp_path, schema) as writer:
+                for part in parts:
+                    writer.write_table(pq.read_table(part).cast(schema))
+        os.replace(tmp_path, path)
+    finally:
+        shutil.rmtree(spool, ignore_errors=True)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return rows
+
+def read_parquet(path, columns=None):
+    """
+    Reads a Parquet file memory-mapped, returning a GeoDataFrame with its geometries
+    decoded if it is a GeoParquet file.
+
+    Parameters
+    ----------
+    path: str
+        Path of the Parquet file.
+    columns: list
+        Columns to read, defaults to all of them.
+    """
+    pa, pq = import_pyarrow()
+    table = pq.read_table(path, columns=columns, memory_map=True)
+    geo = json.loads((table.schema.metadata or {}).get(b'geo', b'{}'))
+    df = table.to_pandas()
+    geometry = geo.get('primary_column')
+    if geometry not in df:
+        return gpd.GeoDataFrame(df)
+    crs = geo['columns'][geometry].get('crs', 'OGC:CRS84')
+    if isinstance(crs, dict):
+        crs = CRS.from_json_dict(crs)
+        crs = f'EPSG:{crs.to_epsg()}' if crs.to_epsg() else crs
+    geometries = gpd.GeoSeries.from_wkb(df[geometry], index=df.index, crs=crs)
+    return gpd.GeoDataFrame(df.drop(columns=geometry), geometry=geometries.rename(geometry), crs=crs)
+
 def flatten_list(nested_list):
     if len(nested_list) > 0:
         return [item for sublist in nested_list for item in sublist]
@@ -227,20 +521,49 @@ def get_geojson_string(geom):
     feat_col = {"type": "FeatureCollection", "features": [{"type": "Feature", "properties": {}, "geometry": geom}]}
     return json.dumps(feat_col)
 
-def parse_filters(filter_objects):
-    filter_whitelist = ['connectorType', 'provider', 'status', 'published', 'protected', 'geoInfo']
-    return_string = ''
-    error_string = ''
-    if filter_objects:
-        for k, v in filter_objects.items():
-            if k in filter_whitelist:
-                return_string += f'{k}={v}&'
-            else:
-                error_string += f' {k},'
-        if error_string:
-            print(f'Unable to filter by{error_string[:-1]}.')
-        return return_string
-    return ''
+def split_filters(filter_objects, server):
+    """
+    Splits a filters dictionary into the query parameters evaluated by the server and
+    the filters left to evaluate locally with filter_matches.
+
+    Values given as a (start, end) tuple, e.g. {'updatedAt': ('2019-01-01', None)},
+    are date ranges and are always evaluated locally.
+    """
+    params = {}
+    local = {}
+    pushdown = server_filters(server)
+    for k, v in (filter_objects or {}).items():
+        if k in pushdown and not isinstance(v, (tuple, list)):
+            params[k] = str(v).lower() if isinstance(v, bool) else v
+        else:
+            local[k] = v
+    return params, local
+
+def filter_matches(attributes, filters):
+    """
+    Do the attributes of an entity pass every filter? Tuple values are inclusive
+    (start, end) ranges of ISO dates, either bound may be None; list attributes
+    match if they contain the value; other values are compared case-insensitively.
+    """
+    for k, v in (filters or {}).items():
+        value = attributes.get(k)
+        if isinstance(v, (tuple, list)):
+            start, end = v
+            if not value:
+                return False
+            if start and value[:len(start)] < start:
+                return False
+            if end and value[:len(end)] > end:
+                return False
+        elif isinstance(value, list):
+            if str(v).lower() not in [str(i).lower() for i in value]:
+                return False
+        elif k == 'name':
+            if str(v).lower() not in str(value or '').lower():
+                return False
+        elif str(value).lower() != str(v).lower():
+            return False
+    return True
 
 def sldDump(sldObj):
     """
@@ -296,6 +619,40 @@ def nested_set(dic, keys, value):
         dic = dic.setdefault(key, {})
     dic[keys[-1]] = value
 
+def parse_includes(includes, server):
+    """
+    Returns the includes string for dataset requests. If includes is None, every
+    relationship the server supports is included.
+    """
+    if includes is None:
+        if server_uses_widgets(server):
+            return 'layer,widget,vocabulary,metadata'
+        return 'layer,metadata'
+    if isinstance(includes, str):
+        includes = includes.split(',')
+    return ','.join([i.strip() for i in includes if i.strip()])
+
+def covers_includes(includes, requested):
+    """Does an includes string contain every relationship of a requested includes string?"""
+    return set(requested.split(',')) - {''} <= set(includes.split(','))
+
+def server_filters(server):
+    """
+    Returns the dataset attributes the server can filter by in /v1/dataset queries,
+    besides text search and sort order (see server_supports_search).
+    """
+    if server_supports_search(server):
+        return ['connectorType', 'provider', 'status', 'published', 'protected', 'geoInfo', 'name']
+    return ['connectorType', 'provider', 'status', 'published', 'protected', 'geoInfo']
+
+def server_supports_search(server):
+    """
+    Does the server evaluate text search and sort order in /v1/dataset queries?
+    """
+    supports_search = ['https://api.resourcewatch.org', 'https://staging-api.resourcewatch.org',
+                       'https://production-api.globalforestwatch.org', 'https://staging-api.globalforestwatch.org']
+    return any(server in s for s in supports_search)
+
 def server_uses_widgets(server):
     """
     Does the server currently set use Widget objects? Response gives True if it does, false if not.
@@ -19,6 +19,7 @@ setuptools.setup(
                         'geojson>=2.4.0',
                         'pypng>=0.0.19',
                         'tqdm>=4.21.0'],
+    extras_require={'parquet': ['pyarrow>=14.0.0']},
     packages=['LMIPy'],
     classifiers=[
         "Programming Language :: Python :: 3",
@@ -1,8 +1,10 @@
 import pytest
+import asyncio
+import requests
 import random
 import os
 import os.path
-from LMIPy import Dataset, Table, Collection, Layer, Metadata, Vocabulary, Widget, Image, ImageCollection, Geometry, utils
+from LMIPy import Dataset, Table, Collection, Layer, Metadata, Vocabulary, Widget, Image, ImageCollection, Geometry, AsyncClient, SearchIndex, Catalog, utils, transport, cache
 
 try:
     API_TOKEN = os.environ.get("API_TOKEN", None)
@@ -27,6 +29,95 @@ def test_search_collection_filters():
     col = Collection(search='forest', object_type=['layer'], filters={'provider': 'gee'}, app=['gfw'])
     assert len(col) > 1
 
+def test_search_collection_core_includes():
+    col = Collection(search='forest', object_type=['dataset'], app=['gfw'], includes=[])
+    assert len(col) > 1
+    assert 'vocabulary' not in col.collection[0]['attributes']
+
+def test_collection_pages_and_iter_items():
+    col = Collection(search='forest', object_type=['dataset'], app=['gfw'], page_size=50)
+    assert len(col.get_entities()) > 50
+    items = col.iter_items()
+    assert next(items)['type'] in ['Dataset', 'Table']
+    streamed = Collection(search='forest', object_type=['dataset'], app=['gfw'], page_size=50, stream=True)
+    assert len(streamed) == 0
+    assert sum(1 for _ in streamed.iter_items()) == len(list(col.iter_items()))
+
+def test_collection_local_search():
+    col = Collection(search='forest', object_type=['dataset'], app=['gfw'], pushdown=False)
+    water = col.search('water')
+    assert len(water) > 0
+    assert len(col.index) >= len(col)
+    assert all('water' in (c['attributes'].get('name') or '').lower() + (c['attributes'].get('description') or '').lower()
+               or 'water' in (c['attributes'].get('slug') or '').lower() for c in water.collection)
+
+def test_collection_materialize():
+    col = Collection(search='forest', object_type=['dataset', 'layer'], app=['gfw'], limit=20)
+    objects = col.materialize(workers=4)
+    assert len(objects) == len(col)
+    assert [o.id for o in col[0:5]] == [c['id'] for c in col.collection[0:5]]
+
+def test_collection_multi_key_order():
+    col = Collection(search='forest', object_type=['dataset'], app=['gfw'], order=['provider', '-updatedAt'], limit=10)
+    keys = [(c['attributes']['provider'], c['attributes']['updatedAt']) for c in col.collection]
+    assert keys == sorted(keys, key=lambda k: k[0]) and len(keys) <= 10
+    for (p1, u1), (p2, u2) in zip(keys, keys[1:]):
+        assert p1 != p2 or u1 >= u2
+
+def test_collection_to_dataframe():
+    col = Collection(search='forest', object_type=['dataset', 'layer'], app=['gfw'])
+    df = col.to_dataframe()
+    assert len(df) == len(col)
+    assert str(df['provider'].dtype) == 'category'
+    assert str(df['updatedAt'].dtype).startswith('datetime64')
+    layers = df[df['type'] == 'Layer']
+    assert all(col.collection[i]['type'] == 'Layer' for i in layers.index)
+
+def test_collection_refresh():
+    col = Collection(search='forest', object_type=['dataset'], app=['gfw'])
+    n = len(col)
+    changes = col.refresh()
+    assert set(changes) == {'added', 'updated', 'deleted'}
+    assert col.watermark
+    assert abs(len(col) - n) <= len(changes['added']) + len(changes['deleted'])
+
+def test_collection_from_datasets():
+    datasets = [{'id': 'a', 'type': 'dataset', 'attributes': {'name': 'Forest loss', 'provider': 'gee',
+                 'layer': [{'id': 'la', 'type': 'layer', 'attributes': {'name': 'Loss layer', 'dataset': 'a'}}]}},
+                {'id': 'b', 'type': 'dataset', 'attributes': {'name': 'Water risk', 'provider': 'csv'}}]
+    col = Collection(search='loss', datasets=datasets, object_type=['dataset', 'layer', 'table'])
+    assert sorted(c['id'] for c in col.collection) == ['a', 'la']
+    col = Collection(datasets=datasets, filters={'provider': 'csv'}, object_type=['dataset', 'table'])
+    assert [c['type'] for c in col.collection] == ['Table']
+
+def test_collection_pushes_search_for_datasets_only():
+    col = Collection(search='forest', datasets=[], object_type=['layer'])
+    col.pushdown = True
+    assert 'search' not in col.split_filters()[0]
+    col.object_type = ['dataset', 'table']
+    assert col.split_filters()[0]['search'] == 'forest'
+
+def test_catalog_sync_and_search(tmp_path):
+    catalog = Catalog(path=str(tmp_path / 'catalog.sqlite'))
+    assert catalog.sync(app=['gfw']) > 0
+    offline = catalog.collection(search='forest', object_type=['dataset'])
+    online = Collection(search='forest', object_type=['dataset'], app=['gfw'], pushdown=False)
+    assert [c['id'] for c in offline.collection] == [c['id'] for c in online.collection]
+
+def test_federated_collection():
+    servers = ['https://api.resourcewatch.org', 'https://production-api.globalforestwatch.org']
+    col = Collection(search='forest', object_type=['dataset'], app=['gfw'], servers=servers)
+    assert len(col) > 0
+    assert {c['server'] for c in col.collection} <= set(servers)
+    keys = [(c['type'], c['id']) for c in col.collection]
+    assert len(keys) == len(set(keys))
+
+def test_collection_iter_objects():
+    col = Collection(search='forest', object_type=['layer'], app=['gfw'], limit=10, lazy=True)
+    layers = list(col.iter_objects(prefetch=3, tile_urls=True))
+    assert [l.id for l in layers] == [c['id'] for c in col.collection]
+    assert all(hasattr(l, 'tile_url') for l in layers)
+
 def test_collection_save():
     col = Collection(search='template', object_type=['dataset'], app=['gfw'], env='staging')
     ds = col[0]
@@ -34,6 +125,7 @@ def test_collection_save():
     col.save(path=save_path)
     assert os.path.exists(save_path) == True
     assert f"{ds.id}.json" in os.listdir(save_path)
+    assert '.lmipy-manifest.json' in os.listdir(save_path)
     _ = [os.remove(save_path+f"/{f}") for f in os.listdir(save_path)] 
     os.rmdir(save_path)  
 
@@ -45,6 +137,24 @@ def test_create_dataset():
     assert type(ds.attributes) == dict
     assert len(ds.attributes) > 0
 
+def test_lazy_dataset():
+    ds = Dataset(id_hash='bb1dced4-3ae8-4908-9f36-6514ae69713f', lazy=True)
+    assert '_lazy' in ds.__dict__ and 'attributes' not in ds.__dict__
+    assert len(ds.attributes) > 0
+    assert type(ds.vocabulary) == list
+
+def test_dataset_selective_includes():
+    ds = Dataset(id_hash='7cf3fab2-3fbe-4980-b572-712207b2c8c7', includes=['layer'])
+    assert ds.includes == 'layer'
+    assert len(ds.layers) > 0
+    assert ds.vocabulary == [] and ds.metadata == []
+
+def test_dataset_get_many():
+    ids = ['bb1dced4-3ae8-4908-9f36-6514ae69713f', 'not-a-dataset', '7cf3fab2-3fbe-4980-b572-712207b2c8c7']
+    datasets, errors = Dataset.get_many(ids)
+    assert [d.id if d else None for d in datasets] == [ids[0], None, ids[2]]
+    assert list(errors.keys()) == ['not-a-dataset']
+
 def test_queries_on_datasets():
     ds = Dataset(id_hash='bd5d7924-611e-4302-9185-8054acb0b44b')
     df = ds.query()
@@ -52,6 +162,28 @@ def test_queries_on_datasets():
     df = ds.query('SELECT fid, ST_ASGEOJSON(the_geom_webmercator) FROM data LIMIT 5')
     assert len(df) == 5
 
+def test_iter_query_on_datasets():
+    ds = Dataset(id_hash='bd5d7924-611e-4302-9185-8054acb0b44b')
+    chunks = list(ds.iter_query('SELECT cartodb_id, fid FROM data WHERE cartodb_id <= 250', chunksize=100))
+    assert all(len(c) <= 100 for c in chunks)
+    assert sum(len(c) for c in chunks) == len(ds.query('SELECT cartodb_id FROM data WHERE cartodb_id <= 250'))
+
+def test_iter_query_streams_unkeyed_results():
+    import pandas as pd
+    ds = Dataset('d-unkeyed', attributes={'id': 'd-unkeyed', 'type': 'dataset',
+                 'attributes': {'name': 'Unkeyed', 'tableName': 't', 'provider': 'cartodb'}}, includes=[])
+    rows = pd.DataFrame({'cartodb_id': [1, 2, None, 3, 3], 'v': range(5)})
+    ds.carto_rows = lambda sql: [{'lo': 1, 'hi': 3, 'n': 5, 'ids': 4, 'distinct_ids': 3}]
+    ds.carto_csv = lambda sql, chunksize: (rows.iloc[i:i + chunksize] for i in range(0, len(rows), chunksize))
+    assert [len(c) for c in ds.iter_query('SELECT * FROM data', chunksize=2)] == [2, 2, 1]
+
+def test_csv_queries_on_datasets():
+    ds = Dataset(id_hash='bd5d7924-611e-4302-9185-8054acb0b44b')
+    sql = 'SELECT cartodb_id, fid FROM data ORDER BY cartodb_id LIMIT 20'
+    df = ds.query(sql, format='csv')
+    assert len(df) == 20
+    assert list(df['cartodb_id']) == list(ds.query(sql)['cartodb_id'])
+
 def test_access_vocab():
     ds = Dataset(id_hash='bb1dced4-3ae8-4908-9f36-6514ae69713f')
     assert type(ds.vocabulary) == list
@@ -72,6 +204,14 @@ def test_access_widget():
     assert type(ds.widget) == list
     assert len(ds.widget) > 0
 
+def test_embedded_children_hydrated_from_payload():
+    layer_payload = {'id': 'abc', 'type': 'layer', 'attributes': {'name': 'Embedded layer', 'dataset': 'xyz'}}
+    ly = Layer(id_hash='abc', attributes=layer_payload, server='https://example.invalid')
+    assert ly.attributes['name'] == 'Embedded layer'
+    widget_payload = {'id': 'def', 'type': 'widget', 'attributes': {'name': 'Embedded widget', 'dataset': 'xyz'}}
+    w = Widget('def', attributes=widget_payload, server='https://example.invalid')
+    assert w.attributes['name'] == 'Embedded widget'
+
 def test_dataset_save():
     ds = Dataset(id_hash='897ecc76-2308-4c51-aeb3-495de0bdca79')
     save_path = './tests'
@@ -158,6 +298,11 @@ def test_get_layer_dataset():
     ds = l.dataset()
     assert ds.id == '7cf3fab2-3fbe-4980-b572-712207b2c8c7'
 
+def test_get_layer_dataset_reuses_instance():
+    l = Layer(id_hash='25dcb710-6b85-4bfa-b09b-e4c70c33f381')
+    assert l.dataset() is l.dataset()
+    assert Layer(id_hash='25dcb710-6b85-4bfa-b09b-e4c70c33f381') is l
+
 def test_layer_intersect():
     l = Layer(id_hash='f13f86cb-08b5-4e6c-bb8d-b4782052f9e5')
     g = Geometry(parameters={'iso': 'BRA', 'adm1': 1, 'adm2': 1})
@@ -454,6 +599,20 @@ def test_table_query():
     df = t.query()
     assert len(df) == 5
 
+def test_table_iter_query_pages_in_order():
+    import pandas as pd
+    t = Table('t-pages', attributes={'id': 't-pages', 'type': 'dataset', 'attributes': {'name': 'Pages'}})
+    sent = []
+    t.decode_query = lambda sql: sent.append(sql) or pd.DataFrame({'id': range(3 if 'OFFSET 0' in sql else 1)})
+    with pytest.raises(ValueError):
+        list(t.iter_query('SELECT * FROM data', chunksize=3))
+    assert [len(f) for f in t.iter_query('SELECT * FROM data', chunksize=3, prefetch=1, order_by='id')] == [3, 1]
+    assert sent[0] == 'SELECT * FROM data ORDER BY id LIMIT 3 OFFSET 0'
+    with pytest.raises(ValueError):
+        list(t.iter_query('SELECT *, row_number() OVER (ORDER BY id) AS n FROM data', chunksize=3))
+    with pytest.raises(ValueError):
+        list(t.iter_query('SELECT * FROM data ORDER BY id', chunksize=3, order_by='id'))
+
 #----- Utils Tests -----#
 
 def test_sld_functions():
@@ -488,3 +647,178 @@ def test_sld_functions():
     sld_str = utils.sldDump(sld_obj)
     assert sld_str == '<RasterSymbolizer> <ColorMap type="ramp" extended="false"> <ColorMapEntry color="#F8EBFF" quantity="-40" /> + <ColorMapEntry color="#ECCAFC" quantity="-20.667" /> + <ColorMapEntry color="#DFA4FF" quantity="-14.667" /> + <ColorMapEntry color="#C26DFE" quantity="-10" /> + <ColorMapEntry color="#9D36F7" quantity="-3.333" /> + <ColorMapEntry color="#6D00E1" quantity="-0.667" /> + <ColorMapEntry color="#3C00AB" /> + </ColorMap> </RasterSymbolizer>'
     assert utils.sldParse(sld_str) == test_sld
+
+def test_decode_geometries():
+    rows = [{'id': 1, 'the_geom': '0101000020E6100000000000000000F03F0000000000000040'},
+            {'id': 2, 'the_geom': None}]
+    gdf = utils.decode_geometries(rows)
+    assert gdf.crs == 'EPSG:4326'
+    assert list(gdf.geometry.x[:1]) == [1.0]
+    assert gdf.geometry.iloc[1] is None
+    gdf = utils.decode_geometries([{'the_geom': {'type': 'Point', 'coordinates': [3, 4]}}])
+    assert gdf.geometry.iloc[0].y == 4
+
+def test_carto_dtypes():
+    fields = {'cartodb_id': {'type': 'number', 'pgtype': 'int4'}, 'area': {'type': 'number', 'pgtype': 'float8'},
+              'name': {'type': 'string'}, 'valid': {'type': 'boolean'}, 'date': {'type': 'date'},
+              'the_geom': {'type': 'geometry'}}
+    dtypes, dates = utils.carto_dtypes(fields)
+    assert dtypes == {'cartodb_id': 'Int64', 'area': 'float64', 'name': str, 'valid': 'boolean', 'the_geom': str}
+    assert dates == ['date']
+
+def test_write_and_read_parquet(tmp_path):
+    pytest.importorskip('pyarrow')
+    pages = [utils.decode_geometries([{'id': 1, 'name': None, 'the_geom': None}]),
+             utils.decode_geometries([{'id': 2, 'name': 'b', 'the_geom': '0101000020E610000000000000000008400000000000001040'}])]
+    path = str(tmp_path / 'query.parquet')
+    assert utils.write_parquet(iter(pages), path) == 2
+    gdf = utils.read_parquet(path)
+    assert gdf.crs == 'EPSG:4326'
+    assert list(gdf.columns) == ['id', 'name', 'geometry']
+    assert list(gdf['name'].isna()) == [True, False] and gdf['name'].iloc[1] == 'b'
+    assert gdf.geometry.iloc[0] is None and gdf.geometry.iloc[1].x == 3.0
+    assert list(utils.read_parquet(path, columns=['id'])['id']) == [1, 2]
+    with pytest.raises(ValueError):
+        utils.write_parquet(iter([pages[1], pages[1].drop(columns='name')]), path)
+    assert len(utils.read_parquet(path)) == 2
+    import pandas as pd
+    pages = [pd.DataFrame({'area': [None], 'n': [1]}), pd.DataFrame({'area': [3.5], 'n': [2]}),
+             pd.DataFrame({'area': [None], 'n': [2.5]})]
+    assert utils.write_parquet(iter(pages), path) == 3
+    df = utils.read_parquet(path)
+    assert str(df['area'].dtype) == 'float64' and df['area'].iloc[1] == 3.5
+    assert list(df['n']) == [1.0, 2.0, 2.5]
+    assert os.listdir(tmp_path) == ['query.parquet']
+
+def test_split_filters_pushes_down_supported_keys():
+    filters = {'provider': 'gee', 'published': True, 'updatedAt': ('2019-01-01', '2019-06-30'), 'env': 'production'}
+    params, local = utils.split_filters(filters, 'https://api.resourcewatch.org')
+    assert params == {'provider': 'gee', 'published': 'true'}
+    assert set(local) == {'updatedAt', 'env'}
+    assert utils.filter_matches({'updatedAt': '2019-06-30T10:00:00.000Z', 'env': 'production'}, local)
+    assert not utils.filter_matches({'updatedAt': '2019-07-01T00:00:00.000Z', 'env': 'production'}, local)
+
+def test_search_index_matches_substrings_and_tags():
+    records = [{'id': 'a', 'attributes': {'name': 'Tree cover loss', 'slug': 'tree_cover_loss'}},
+               {'id': 'b', 'attributes': {'name': 'Water risk', 'description': 'Baseline water stress',
+                                          'vocabulary': [{'attributes': {'tags': ['forest']}}]}},
+               {'id': 'c', 'attributes': {'name': 'Protected areas'}}]
+    index = SearchIndex(records)
+    assert [r['id'] for r in index.search('cover')] == ['a']
+    assert [r['id'] for r in index.search('ater str')] == ['b']
+    assert [r['id'] for r in index.search('forest')] == ['b']
+    assert [r['id'] for r in index.search('loss risk')] == ['a', 'b']
+    assert len(index.search('')) == 3
+
+#----- Transport Tests -----#
+
+def test_transport_shares_session_per_server():
+    t = transport.get_transport()
+    rw = t.session('https://api.resourcewatch.org/v1/dataset')
+    assert rw is t.session('https://api.resourcewatch.org/v1/layer/abc')
+    assert rw is not t.session('https://production-api.globalforestwatch.org/v1/geostore')
+
+def test_response_cache_bounded_by_bytes():
+    def response(size):
+        r = requests.models.Response()
+        r.status_code = 200
+        r.headers['ETag'] = '"abc"'
+        r._content = b'x' * size
+        return r
+    cache = transport.ResponseCache(max_entries=10, max_bytes=800)
+    cache.set('https://api.resourcewatch.org/v1/dataset/big', response(101))
+    assert cache.get('https://api.resourcewatch.org/v1/dataset/big') is None
+    for n in range(9):
+        cache.set(f'https://api.resourcewatch.org/v1/dataset/{n}', response(100))
+    assert len(cache) == 8 and cache.size == 800
+    assert cache.get('https://api.resourcewatch.org/v1/dataset/0') is None
+
+def test_transport_refetches_unmatched_not_modified():
+    not_modified, ok = requests.models.Response(), requests.models.Response()
+    not_modified.status_code, ok.status_code = 304, 200
+    ok._content = b'{}'
+    sent, responses = [], [not_modified, ok]
+    t = transport.Transport()
+    t.cache.validators = lambda url: {'If-None-Match': '"evicted"'}
+    t.request = lambda method, url, headers=None, **kwargs: sent.append(dict(headers)) or responses.pop(0)
+    assert t.get('https://api.resourcewatch.org/v1/dataset/a') is ok
+    assert 'If-None-Match' in sent[0] and 'If-None-Match' not in sent[1]
+
+#----- AsyncClient Tests -----#
+
+def test_async_client_gather():
+    async def fetch():
+        async with AsyncClient() as client:
+            return await asyncio.gather(client.dataset('bb1dced4-3ae8-4908-9f36-6514ae69713f'),
+                                        client.layer('dc6f6dd2-0718-4e41-81d2-109866bb9edd'))
+    ds, ly = asyncio.run(fetch())
+    assert ds.id == 'bb1dced4-3ae8-4908-9f36-6514ae69713f'
+    assert ly.id == 'dc6f6dd2-0718-4e41-81d2-109866bb9edd'
+
+def test_response_cache_revalidation_headers():
+    r = requests.models.Response()
+    r.status_code = 200
+    r.headers['ETag'] = '"abc"'
+    r._content = b'{}'
+    cache = transport.ResponseCache(max_entries=1)
+    cache.set('https://api.resourcewatch.org/v1/dataset/a', r)
+    assert cache.validators('https://api.resourcewatch.org/v1/dataset/a') == {'If-None-Match': '"abc"'}
+    cache.set('https://api.resourcewatch.org/v1/dataset/b', r)
+    assert cache.get('https://api.resourcewatch.org/v1/dataset/a') is None
+
+#----- Cache Tests -----#
+
+def test_query_cache_versions_and_tiers(tmp_path):
+    import pandas as pd
+    qc = cache.QueryCache(path=str(tmp_path / 'queries.sqlite'), max_entries=1)
+    server = 'https://api.resourcewatch.org'
+    df = pd.DataFrame({'a': [1, 2]})
+    qc.set(server, 'ds', "SELECT *  FROM data WHERE b = 'x  y';", 'v1', df)
+    assert qc.get(server, 'ds', "SELECT * FROM data WHERE b = 'x  y'", 'v1').equals(df)
+    assert qc.get(server, 'ds', "SELECT * FROM data WHERE b = 'x y'", 'v1') is None
+    qc.set(server, 'ds', 'SELECT 1', 'v1', df)
+    assert qc.get(server, 'ds', "SELECT * FROM data WHERE b = 'x  y'", 'v1').equals(df)
+    assert qc.get(server, 'ds', 'SELECT 1', 'v2') is None
+
+def test_entity_cache_ttl_and_eviction(tmp_path):
+    c = cache.EntityCache(path=str(tmp_path / 'cache.sqlite'), max_bytes=60, ttl={'layer': 0})
+    server = 'https://api.resourcewatch.org'
+    c.set(server, 'dataset', 'a', 'layer', {'name': 'a' * 20})
+    assert c.get(server, 'dataset', 'a', 'layer') == {'name': 'a' * 20}
+    assert c.get(server, 'dataset', 'a', 'metadata') is None
+    c.set(server, 'dataset', 'b', 'layer', {'name': 'b' * 20})
+    assert c.get(server, 'dataset', 'a', 'layer') is None
+    c.set(server, 'layer', 'c', '', {'name': 'c'})
+    assert c.get(server, 'layer', 'c') is None
+    c.invalidate(server, 'dataset', 'b')
+    assert len(c) == 0
+
+def test_identity_map_newer_payload_wins():
+    def payload(name):
+        return {'id': 'd-payload', 'type': 'dataset', 'attributes': {'name': name, 'provider': 'gee',
+                'layer': [{'id': 'l-payload', 'type': 'layer', 'attributes': {'name': name + ' layer'}}],
+                'widget': [{'id': 'w-payload', 'type': 'widget', 'attributes': {'name': name + ' widget'}}]}}
+    old = Dataset('d-payload', attributes=payload('Old'), includes=['layer', 'widget'])
+    new = Dataset('d-payload', attributes=payload('New'), includes=['layer', 'widget'])
+    assert new is old
+    assert new.attributes['name'] == 'New'
+    assert new.layers[0].attributes['name'] == 'New layer'
+    assert new.widget[0].attributes['name'] == 'New widget'
+    assert Dataset('d-payload', includes=['layer', 'widget']) is new
+    core = {'id': 'd-payload', 'type': 'dataset', 'attributes': {'name': 'Core', 'provider': 'gee'}}
+    assert Dataset('d-payload', attributes=core, includes=[]) is new
+    assert new.attributes['name'] == 'Core' and new.includes == 'layer,widget'
+    assert new.layers[0].attributes['name'] == 'New layer'
+    layer = new.layers[0]
+    layer.attributes['vocabulary'] = [{'id': 'v'}]
+    Layer('l-payload', attributes={'id': 'l-payload', 'type': 'layer', 'attributes': {'name': 'Embedded'}})
+    assert layer.attributes == {'name': 'Embedded', 'vocabulary': [{'id': 'v'}]}
+
+def test_updated_dataset_stays_mapped(monkeypatch):
+    ds = Dataset('d-update', attributes={'id': 'd-update', 'type': 'dataset', 'attributes': {'name': 'Old'}}, includes=[])
+    response = requests.models.Response()
+    response.status_code, response._content = 200, b'{"data": {}}'
+    monkeypatch.setattr(transport, 'patch', lambda url, **kwargs: response)
+    monkeypatch.setattr(ds, 'get_dataset', lambda fresh=False: {'name': 'New'})
+    assert ds.update(update_params={'name': 'New'}, token='token') is ds
+    assert Dataset('d-update', includes=[]) is ds and ds.attributes['name'] == 'New'